@@ -0,0 +1,322 @@
+#!/bin/python3
+import argparse
+import concurrent.futures
+import difflib
+import glob
+import json
+import logging
+import os
+import random
+import resource
+import string
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import yaml
+
+import index
+
+
+def random_plate(rng):
+    return ''.join(rng.choice(string.ascii_uppercase + string.digits) for _ in range(7))
+
+def misread(rng, plate):
+    position = rng.randrange(len(plate))
+    return plate[:position] + rng.choice(string.ascii_uppercase + string.digits) + plate[position + 1:]
+
+def linear_match(watched_plates, plate_number):
+    # the previous check_watched_plates implementation, for comparison
+    watched_plates = [str(x).lower() for x in watched_plates]
+    max_score = 0
+    best_match = None
+    for watched_plate in watched_plates:
+        ratio = difflib.SequenceMatcher(a=str(plate_number).lower(), b=watched_plate).ratio()
+        if ratio > max_score:
+            max_score = ratio
+            best_match = watched_plate
+    return best_match, max_score
+
+def benchmark_matcher(args):
+    rng = random.Random(args.seed)
+    print(f"{'plates':>8} {'build (ms)':>12} {'exact (us)':>12} {'fuzzy (us)':>12} {'linear (us)':>12}")
+    for size in args.sizes:
+        plates = [random_plate(rng) for _ in range(size)]
+        queries = [misread(rng, rng.choice(plates)) for _ in range(args.lookups)]
+
+        start_time = time.perf_counter()
+        matcher = index.PlateMatcher(plates)
+        build_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        for query in queries:
+            matcher.match(query)
+        exact_time = (time.perf_counter() - start_time) / len(queries)
+
+        start_time = time.perf_counter()
+        for query in queries:
+            matcher.match(query, args.fuzzy_match, args.top_k)
+        fuzzy_time = (time.perf_counter() - start_time) / len(queries)
+
+        linear_queries = queries[:max(1, min(len(queries), 100000 // size))]
+        start_time = time.perf_counter()
+        for query in linear_queries:
+            linear_match(plates, query)
+        linear_time = (time.perf_counter() - start_time) / len(linear_queries)
+
+        print(f"{size:>8} {build_time * 1e3:>12.1f} {exact_time * 1e6:>12.1f} {fuzzy_time * 1e6:>12.1f} {linear_time * 1e6:>12.1f}")
+
+def benchmark_inference(args):
+    with open(args.config) as config_file:
+        index.config = yaml.safe_load(config_file)
+    index._LOGGER = logging.getLogger(__name__)
+    images = [cv2.imread(path) for path in sorted(glob.glob(os.path.join(args.images, '*.jpg')))]
+    if not images:
+        raise SystemExit(f"No .jpg images found in {args.images}")
+    frames = [images[i % len(images)] for i in range(args.frames)]
+    index.get_alpr()
+
+    def run(label):
+        index.run_alpr(frames[0])
+        start_time = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            plates = sum(len(results) for results in pool.map(index.run_alpr, frames))
+        duration = time.perf_counter() - start_time
+        print(f"{label:>10}: {len(frames) / duration:8.1f} frames/s {plates / duration:8.1f} plates/s")
+
+    index.inference_batcher = None
+    run('per frame')
+    index.inference_batcher = index.InferenceBatcher(args.batch_size, args.batch_wait_ms / 1000)
+    run('batched')
+
+class FrigateStandIn(ThreadingHTTPServer):
+    # serves recorded snapshots on the Frigate API paths used by FrigateClient
+    daemon_threads = True
+
+    def __init__(self, events_dir):
+        super().__init__(('127.0.0.1', 0), FrigateStandInHandler)
+        self.events_dir = events_dir
+        self.events = {}
+        self.requests = 0
+
+    def find_snapshot(self, camera, event_id=None):
+        names = ([self.events[event_id]['id']] if event_id in self.events else []) + [camera]
+        for name in names:
+            for extension in ('.jpg', '.png'):
+                path = os.path.join(self.events_dir, name + extension)
+                if os.path.isfile(path):
+                    return path
+        return None
+
+class FrigateStandInHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests += 1
+        parts = self.path.split('?')[0].strip('/').split('/')
+        path = None
+        if len(parts) == 3 and parts[0] == 'api' and parts[2] == 'latest.jpg':
+            path = self.server.find_snapshot(parts[1])
+        elif len(parts) == 4 and parts[:2] == ['api', 'events']:
+            event = self.server.events.get(parts[2])
+            path = self.server.find_snapshot(event['camera'], parts[2]) if event else None
+        if path is None:
+            self.send_error(404)
+            return
+        with open(path, 'rb') as snapshot_file:
+            body = snapshot_file.read()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class StubMqttClient:
+    # stands in for the broker connection, publishes are only counted
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append(topic)
+
+    def subscribe(self, topic):
+        pass
+
+class StubMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+def get_frame_time(message):
+    for data in (message.get('after') or {}, message.get('before') or {}):
+        if data.get('frame_time') is not None:
+            return data['frame_time']
+    return None
+
+def load_recorded_messages(events_dir, repeat):
+    # returns (seconds since the first message, message) pairs in replay order
+    messages = []
+    for path in sorted(glob.glob(os.path.join(events_dir, '*.json'))):
+        with open(path) as event_file:
+            payload = json.load(event_file)
+        messages.extend(payload if isinstance(payload, list) else [payload])
+    if not messages:
+        raise SystemExit(f"No .json events found in {events_dir}")
+
+    # messages without a frame_time are sent together with the message before them
+    offsets = []
+    first_frame_time = next((frame_time for frame_time in map(get_frame_time, messages) if frame_time is not None), 0)
+    offset = 0
+    for message in messages:
+        frame_time = get_frame_time(message)
+        if frame_time is not None:
+            offset = max(frame_time - first_frame_time, 0)
+        offsets.append(offset)
+
+    # every repeat gets its own event ids, so it is not skipped as an already processed event, and is replayed
+    # at the same time as the others
+    replayed = []
+    for run in range(repeat):
+        for offset, message in zip(offsets, messages):
+            message = json.loads(json.dumps(message))
+            for data in (message.get('before') or {}, message.get('after') or {}):
+                if 'id' in data:
+                    data['id'] = f"{data['id']}-{run}"
+            replayed.append((offset, message))
+    replayed.sort(key=lambda replayed_message: replayed_message[0])
+    return replayed
+
+def percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(int(len(values) * percent / 100), len(values) - 1)]
+
+def benchmark_replay(args):
+    with open(args.config) as config_file:
+        index.config = yaml.safe_load(config_file)
+    index._LOGGER = logging.getLogger(__name__)
+    messages = load_recorded_messages(args.events, args.repeat)
+
+    tmp_dir = tempfile.TemporaryDirectory()
+    frigate = FrigateStandIn(args.events)
+    threading.Thread(target=frigate.serve_forever, daemon=True).start()
+    index.config['frigate'].update(frigate_url=f"http://127.0.0.1:{frigate.server_port}", recognition_workers=args.concurrency)
+    index.DB_PATH = os.path.join(tmp_dir.name, 'replay.db')
+    index.SNAPSHOT_PATH = os.path.join(tmp_dir.name, 'plates')
+    index.mqtt_client = StubMqttClient()
+    index.executor = concurrent.futures.ThreadPoolExecutor(max_workers=10)
+    index.delayed_actions = index.DelayedActions()
+    index.setup_db()
+    index.setup_frigate_client()
+    index.start_db_writer()
+    if index.config.get('fast_alpr'):
+        if not index.is_process_inference(index.config):
+            index.get_alpr()
+        index.setup_inference()
+
+    # only events with at least one recognition attempt count as completed, an event ended before its
+    # first attempt measured nothing
+    started = {}
+    finished = {}
+    unattempted = set()
+    def record_finish(event):
+        if event['id'] in finished or event['id'] in unattempted:
+            return
+        if event['attempts']:
+            finished[event['id']] = time.perf_counter()
+        else:
+            unattempted.add(event['id'])
+    finish_event, cancel_event = index.finish_event, index.cancel_event
+    def record_finish_event(event, reason):
+        record_finish(event)
+        return finish_event(event, reason)
+    def record_cancel_event(frigate_event_id):
+        event = index.CURRENT_EVENTS.get(frigate_event_id)
+        if event is not None:
+            record_finish(event)
+        return cancel_event(frigate_event_id)
+    index.finish_event = record_finish_event
+    index.cancel_event = record_cancel_event
+    scheduler_threads = index.start_event_scheduler()
+
+    try:
+        usage_before = resource.getrusage(resource.RUSAGE_SELF)
+        start_time = time.perf_counter()
+        for number, (offset, message) in enumerate(messages):
+            if args.rate is None:
+                time.sleep(max(start_time + offset / args.speed - time.perf_counter(), 0))
+            elif args.rate:
+                time.sleep(max(start_time + number / args.rate - time.perf_counter(), 0))
+            after_data = message.get('after') or {}
+            if 'id' in after_data:
+                frigate.events[after_data['id']] = {'id': after_data['id'].rsplit('-', 1)[0], 'camera': after_data.get('camera')}
+                started.setdefault(after_data['id'], time.perf_counter())
+            index.process_message(StubMessage(f"{index.config['frigate']['main_topic']}/events", json.dumps(message)))
+
+        drain_deadline = time.perf_counter() + args.drain_timeout
+        while index.CURRENT_EVENTS and time.perf_counter() < drain_deadline:
+            time.sleep(0.01)
+        duration = time.perf_counter() - start_time
+        usage_after = resource.getrusage(resource.RUSAGE_SELF)
+    finally:
+        index.stop_event_scheduler(scheduler_threads)
+        index.finish_event, index.cancel_event = finish_event, cancel_event
+        index.stop_db_writer()
+        index.executor.shutdown(wait=False)
+        index.delayed_actions.stop()
+        frigate.shutdown()
+        frigate.server_close()
+        tmp_dir.cleanup()
+
+    latencies = [finished[event_id] - started[event_id] for event_id in started if event_id in finished]
+    cpu_time = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+    print(f"messages: {len(messages)} events: {len(started)} completed: {len(latencies)} "
+          f"ended without attempt: {len(unattempted)} unfinished: {len(index.CURRENT_EVENTS)}")
+    print(f"throughput: {len(latencies) / duration:.1f} events/s {len(messages) / duration:.1f} messages/s")
+    print(f"latency (ms): p50 {percentile(latencies, 50) * 1e3:.1f} p95 {percentile(latencies, 95) * 1e3:.1f} "
+          f"p99 {percentile(latencies, 99) * 1e3:.1f}")
+    print(f"cpu: {cpu_time / duration * 100:.0f}% rss: {index.get_rss_bytes() / 1048576:.1f}MB "
+          f"snapshot requests: {frigate.requests} mqtt publishes: {len(index.mqtt_client.published)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Frigate Plate Recognizer benchmarks")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    matcher_parser = subparsers.add_parser('matcher', help="watched plate lookup latency")
+    matcher_parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 100000])
+    matcher_parser.add_argument('--lookups', type=int, default=1000)
+    matcher_parser.add_argument('--fuzzy-match', type=float, default=0.8)
+    matcher_parser.add_argument('--top-k', type=int, default=3)
+    matcher_parser.add_argument('--seed', type=int, default=0)
+    matcher_parser.set_defaults(func=benchmark_matcher)
+
+    inference_parser = subparsers.add_parser('inference', help="per frame vs batched ALPR throughput")
+    inference_parser.add_argument('--config', default=index.CONFIG_PATH)
+    inference_parser.add_argument('--images', required=True, help="directory of .jpg snapshots")
+    inference_parser.add_argument('--frames', type=int, default=200)
+    inference_parser.add_argument('--concurrency', type=int, default=10)
+    inference_parser.add_argument('--batch-size', type=int, default=8)
+    inference_parser.add_argument('--batch-wait-ms', type=float, default=10)
+    inference_parser.set_defaults(func=benchmark_inference)
+
+    replay_parser = subparsers.add_parser('replay', help="end to end throughput replaying recorded Frigate events")
+    replay_parser.add_argument('--config', default=index.CONFIG_PATH)
+    replay_parser.add_argument('--events', required=True,
+                               help="directory of recorded MQTT event .json files and [event id].jpg or [camera].jpg snapshots")
+    replay_parser.add_argument('--rate', type=float, help="messages per second instead of the recorded frame_time, "
+                                                          "0 replays as fast as possible")
+    replay_parser.add_argument('--speed', type=float, default=1, help="speed up replay by recorded frame_time")
+    replay_parser.add_argument('--concurrency', type=int, default=10, help="recognition workers")
+    replay_parser.add_argument('--repeat', type=int, default=1)
+    replay_parser.add_argument('--drain-timeout', type=float, default=60)
+    replay_parser.set_defaults(func=benchmark_replay)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
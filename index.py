@@ -1,24 +1,51 @@
 #!/bin/python3
+import argparse
+import asyncio
+import atexit
 import base64
+import bisect
+import collections
+import contextlib
 import threading
 import concurrent.futures
+import copy
+import dataclasses
+import hashlib
+import heapq
+import itertools
+import math
 import os
+import queue
+import resource
+import signal
 import sqlite3
+import statistics
+import tempfile
 import time
 import logging
-import uuid
+import multiprocessing
+from multiprocessing import shared_memory
+import random
+import re
 from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import cv2
 import numpy as np
+import onnxruntime
 import paho.mqtt.client as mqtt
 import yaml
 import sys
 import json
 import requests
-import difflib
+try:
+    import orjson
+except ImportError:
+    orjson = None
 from fast_alpr import ALPR
+from fast_alpr.alpr import ALPRResult
+from fast_alpr.base import BoundingBox, DetectionResult, OcrResult
 
 
 mqtt_client = None
@@ -27,6 +54,7 @@ first_message = True
 _LOGGER = None
 
 executor = None
+delayed_actions = None
 
 VERSION = '2.1.1'
 
@@ -48,11 +76,159 @@ DEFAULT_OBJECTS = ['car', 'motorcycle', 'bus']
 CURRENT_EVENTS = {}
 
 matched = None
-event_type = None
+
+events_lock = threading.Lock()
+scheduler_condition = threading.Condition(events_lock)
+work_condition = threading.Condition(events_lock)
+scheduler_stopped = threading.Event()
+work_queue = collections.deque()
+SCHEDULER_STATS = {'queued': 0, 'dropped': 0, 'attempts': 0}
+ASYNC_EVENTS = {}
+pending_end_messages = set()
+INGEST_STATS = {'dropped': 0, 'filtered': 0, 'queued': 0}
+EVENT_TYPE_PATTERN = re.compile(rb'"type"\s*:\s*"([^"]*)"')
+CAMERA_PATTERN = re.compile(rb'"camera"\s*:\s*"([^"]*)"')
+LABEL_PATTERN = re.compile(rb'"label"\s*:\s*"([^"]*)"')
+ingest_queue = None
+ingest_overflow = collections.deque()
+UNRESOLVED_EVENTS = collections.OrderedDict()
+unresolved_events_lock = threading.Lock()
+clip_scan_queue = None
+CLIP_SCAN_STATS = {'queued': 0, 'dropped': 0, 'scanned': 0, 'found': 0, 'failed': 0}
+STREAM_READERS = {}
+stream_readers_lock = threading.Lock()
+
+VEHICLE_DATA_KEYS = ['fuzzy_score', 'matched', 'detected_plate_number', 'detected_plate_ocr_score', 'frigate_event_id',
+                     'watched_plates', 'camera_name', 'plate_image', 'watched_plate']
+VEHICLE_DATA_COMPONENTS = {'matched': 'binary_sensor', 'plate_image': 'camera'}
+
+LAST_FRAMES = {}
+FRAME_DEDUP_STATS = {'exact': 0, 'similar': 0, 'processed': 0}
+last_frames_lock = threading.Lock()
+PLATE_READS = {}
+plate_reads_lock = threading.Lock()
+
+DB_TIMEOUT = 30
+RESOLVED_EVENTS_CACHE_SIZE = 10000
+db_local = threading.local()
+RESOLVED_EVENTS = collections.OrderedDict()
+resolved_events_lock = threading.Lock()
+db_write_queue = queue.Queue()
+db_writer_thread = None
+DB_WRITER_STATS = {'written': 0, 'batches': 0, 'failed': 0}
+RETENTION_STATS = {'deleted': 0, 'deleted_bytes': 0, 'failed': 0}
+EVENT_COUNTERS = {'received': 0, 'filtered': 0, 'deduped': 0, 'matched': 0}
+event_counters_lock = threading.Lock()
+READABILITY_STATS = {'now': 0, 'later': 0, 'never': 0}
+metrics_server = None
+EVENT_TRACES = {}
+event_traces_lock = threading.Lock()
+trace_local = threading.local()
+
+ALPR_MODELS = {}
+ALPR_MODEL_STATS = {}
+alpr_models_lock = threading.Lock()
+config_mtime = None
+watched_plate_matcher = None
+OCR_CONFUSIONS = str.maketrans({'O': '0', 'Q': '0', 'I': '1', 'L': '1', 'B': '8', 'S': '5', 'Z': '2', 'G': '6'})
+frigate_client = None
+inference_batcher = None
+process_pool = None
+process_pool_lock = threading.Lock()
+PROCESS_POOL_STATE = {'failures': 0, 'retry_at': None}
+# fast_alpr settings that need the worker processes or the batcher to be set up again
+PROCESS_SETTINGS = ('inference_mode', 'process_workers', 'intra_op_threads')
+INFERENCE_SETTINGS = PROCESS_SETTINGS + ('batch_size', 'batch_wait_ms')
+
+class Histogram:
+    # prometheus style histogram, bucket counts are kept per bucket and made cumulative when rendered
+    def __init__(self, buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self.lock:
+            return list(itertools.accumulate(self.counts)), self.sum
+
+STAGE_DURATIONS = {stage: Histogram() for stage in
+                   ('snapshot', 'decode', 'detection', 'ocr', 'fuzzy_match', 'db_write', 'image_save', 'mqtt_publish')}
+
+@contextlib.contextmanager
+def stage(name):
+    # times a pipeline stage into its histogram, and into the trace of the event handled by this thread
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start_time
+        if name in STAGE_DURATIONS:
+            STAGE_DURATIONS[name].observe(duration)
+        add_trace_span(name, start_time, duration)
+
+def timed(name, function):
+    def wrapper(*args, **kwargs):
+        with stage(name):
+            return function(*args, **kwargs)
+    return wrapper
+
+def start_trace(frigate_event_id, camera):
+    if random.random() >= config.get('trace_sample_rate', 1.0):
+        return
+    with event_traces_lock:
+        EVENT_TRACES[frigate_event_id] = {
+            'camera': camera,
+            'started': time.time(),
+            'start_time': time.perf_counter(),
+            'attempt': 0,
+            'spans': [],
+        }
+
+def run_traced(frigate_event_id, function, *args):
+    # stages run by function on this thread are added to the event's trace
+    trace_local.event_id = frigate_event_id
+    try:
+        return function(*args)
+    finally:
+        trace_local.event_id = None
+
+def trace_attempt(frigate_event_id):
+    with event_traces_lock:
+        trace = EVENT_TRACES.get(frigate_event_id)
+        if trace is not None:
+            trace['attempt'] += 1
+
+def add_trace_span(name, start_time, duration):
+    frigate_event_id = getattr(trace_local, 'event_id', None)
+    if frigate_event_id is None:
+        return
+    with event_traces_lock:
+        trace = EVENT_TRACES.get(frigate_event_id)
+        if trace is not None:
+            trace['spans'].append((name, trace['attempt'], round((start_time - trace['start_time']) * 1000, 2), round(duration * 1000, 2)))
+
+def finish_trace(frigate_event_id, attempts, outcome):
+    with event_traces_lock:
+        trace = EVENT_TRACES.pop(frigate_event_id, None)
+    if trace is None:
+        return
+    db_write_queue.put((
+        """INSERT INTO traces (frigate_event_id, camera, started, duration, attempts, outcome, spans) VALUES (?, ?, ?, ?, ?, ?, ?)""",
+        (frigate_event_id, trace['camera'], trace['started'], time.perf_counter() - trace['start_time'], attempts, outcome,
+         json.dumps(trace['spans']))
+    ))
 
 def on_connect(mqtt_client, userdata, flags, reason_code, properties):
     _LOGGER.info("MQTT Connected")
     mqtt_client.subscribe(config['frigate']['main_topic'] + "/events")
+    mqtt_client.subscribe(get_homeassistant_config().get('status_topic', 'homeassistant/status'))
+    publish_discovery(mqtt_client)
 
 def on_disconnect(mqtt_client, userdata, flags, reason_code, properties):
     if reason_code != 0:
@@ -68,159 +244,1009 @@ def on_disconnect(mqtt_client, userdata, flags, reason_code, properties):
         _LOGGER.error("Expected disconnection")
 
 def on_message(client, userdata, message):
-   process_message(message)
-
-def process_message(message):
-
-    global event_type
-    global matched
-    payload_dict = json.loads(message.payload)
+   if is_homeassistant_status(message):
+       on_homeassistant_status(client, message)
+       return
+   enqueue_message(message)
+
+def is_relevant_payload(payload):
+    # cheap check on the raw payload, so updates for other cameras and objects are never decoded
+    if not config['frigate'].get('ingest_prefilter', True):
+        return True
+    if get_payload_event_type(payload) not in (b'new', b'update', b'end'):
+        return False
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    cameras = config['frigate'].get('camera', [])
+    if cameras and not set(CAMERA_PATTERN.findall(payload)) & {camera.encode('utf-8') for camera in cameras}:
+        return False
+    labels = config['frigate'].get('objects', DEFAULT_OBJECTS)
+    return bool(set(LABEL_PATTERN.findall(payload)) & {label.encode('utf-8') for label in labels})
+
+def enqueue_message(message):
+    # runs on the paho network thread, which has to get back to its keepalives quickly
+    if not is_relevant_payload(message.payload):
+        INGEST_STATS['filtered'] += 1
+        return
+    if ingest_queue is None:
+        process_message(message)
+        return
+    try:
+        ingest_queue.put_nowait(message)
+        INGEST_STATS['queued'] += 1
+        return
+    except queue.Full:
+        pass
+    if get_payload_event_type(message.payload) != b'end':
+        INGEST_STATS['dropped'] += 1
+        _LOGGER.debug("MQTT message queue full, dropping message")
+        return
+    # an end message is never dropped, a missed end would leave its event running, so an update makes room for it.
+    # Without queued updates it is held next to the queue, blocking here would stall the MQTT keepalives
+    if not evict_update_message(message):
+        ingest_overflow.append(message)
+        _LOGGER.warning("MQTT message queue full, holding an end message until the queue is processed")
+    INGEST_STATS['queued'] += 1
+
+def get_payload_event_type(payload):
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    event_type = EVENT_TYPE_PATTERN.search(payload)
+    return event_type.group(1) if event_type else None
+
+def evict_update_message(message):
+    with ingest_queue.mutex:
+        for position, queued in enumerate(ingest_queue.queue):
+            if get_payload_event_type(queued.payload) == b'update':
+                del ingest_queue.queue[position]
+                ingest_queue.queue.append(message)
+                ingest_queue.not_empty.notify()
+                break
+        else:
+            return False
+    INGEST_STATS['dropped'] += 1
+    _LOGGER.debug("MQTT message queue full, dropping an update for an end message")
+    return True
+
+def get_ingest_message(message_queue):
+    # held end messages are processed once everything queued before them is done
+    try:
+        return message_queue.get_nowait()
+    except queue.Empty:
+        pass
+    try:
+        return ingest_overflow.popleft()
+    except IndexError:
+        pass
+    try:
+        return message_queue.get(timeout=1)
+    except queue.Empty:
+        return None
+
+def run_ingest(message_queue):
+    while True:
+        message = get_ingest_message(message_queue)
+        if message is None:
+            continue
+        try:
+            process_message(message)
+        except Exception as e:
+            _LOGGER.error(f"Failed to process MQTT message: {e}")
+
+def start_ingest():
+    global ingest_queue
+    ingest_queue = queue.Queue(maxsize=config['frigate'].get('max_queued_messages', 1000))
+    threading.Thread(target=run_ingest, args=(ingest_queue,), daemon=True).start()
+
+def get_ingest_stats():
+    return dict(INGEST_STATS, queue_depth=ingest_queue.qsize() + len(ingest_overflow) if ingest_queue is not None else 0)
+
+def count_event(result):
+    with event_counters_lock:
+        EVENT_COUNTERS[result] += 1
+
+def get_event_counters():
+    with event_counters_lock:
+        return dict(EVENT_COUNTERS)
+
+def parse_event_message(message, check_duplicate=True):
+    count_event('received')
+    payload_dict = orjson.loads(message.payload) if orjson is not None else json.loads(message.payload)
     _LOGGER.debug(f"MQTT message: {payload_dict}")
 
     before_data = payload_dict.get("before", {})
     after_data = payload_dict.get("after", {})
     event_type = payload_dict.get("type", "")
-    frigate_url = config["frigate"]["frigate_url"]
-    frigate_event_id = after_data["id"]
+
+    if event_type == "end":
+        return event_type, after_data
 
     if check_invalid_event(before_data, after_data):
-        return
+        count_event('filtered')
+        return None
+
+    if check_duplicate and event_type == "new" and is_duplicate_event(after_data["id"]):
+        count_event('deduped')
+        return None
+
+    return event_type, after_data
 
-    if is_duplicate_event(frigate_event_id):
+def process_message(message):
+
+    global matched
+    parsed_message = parse_event_message(message)
+    if parsed_message is None:
         return
+    event_type, after_data = parsed_message
+    frigate_url = config["frigate"]["frigate_url"]
+    frigate_event_id = after_data["id"]
 
-    if event_type == "new":
-        print(f"Starting new thread for new event{event_type} for {frigate_event_id}***************")
+    if event_type == "end":
+        cancel_event(frigate_event_id)
+        request_clip_scan(after_data)
+    elif event_type == "update":
+        update_event(frigate_event_id, after_data)
+    elif event_type == "new":
+        _LOGGER.info(f"Scheduling new event {frigate_event_id}")
         matched = False
-        thread = threading.Thread(
-            target=process_event,
-            args=(before_data, after_data, frigate_url, frigate_event_id),
-            daemon=True,
-        )
+        start_event(after_data, frigate_url, frigate_event_id)
+
+def start_event(after_data, frigate_url, frigate_event_id):
+    event_timeout = config['frigate'].get('event_timeout', 300)
+    with events_lock:
+        if frigate_event_id in CURRENT_EVENTS:
+            return
+        CURRENT_EVENTS[frigate_event_id] = {
+            'id': frigate_event_id,
+            'after_data': after_data,
+            'frigate_url': frigate_url,
+            'attempts': 0,
+            'in_flight': False,
+            'cancelled': False,
+            'next_attempt': time.monotonic(),
+            'deadline': time.monotonic() + event_timeout if event_timeout else None,
+        }
+        scheduler_condition.notify()
+    start_trace(frigate_event_id, after_data['camera'])
+    prepare_frame_source(after_data['camera'])
+
+def update_event(frigate_event_id, after_data):
+    with events_lock:
+        event = CURRENT_EVENTS.get(frigate_event_id)
+        if event is None:
+            return
+        event['after_data'] = after_data
+        if not event['in_flight']:
+            event['next_attempt'] = time.monotonic()
+            scheduler_condition.notify()
+
+def cancel_event(frigate_event_id):
+    with events_lock:
+        event = CURRENT_EVENTS.pop(frigate_event_id, None)
+        if event is None:
+            return
+        event['cancelled'] = True
+        if event in work_queue:
+            work_queue.remove(event)
+    remember_unresolved_event(frigate_event_id)
+    forget_event_state(frigate_event_id)
+    finish_trace(frigate_event_id, event['attempts'], "ended")
+    _LOGGER.info(f"Event {frigate_event_id} ended after {event['attempts']} attempts")
+
+def finish_event(event, reason):
+    # must be called with events_lock held
+    CURRENT_EVENTS.pop(event['id'], None)
+    event['cancelled'] = True
+    if reason in ("max attempts reached", "deadline reached"):
+        remember_unresolved_event(event['id'])
+    forget_event_state(event['id'])
+    finish_trace(event['id'], event['attempts'], reason)
+    _LOGGER.info(f"Done processing event {event['id']} after {event['attempts']} attempts: {reason}")
+
+def enqueue_event(event):
+    # must be called with events_lock held
+    max_queued_events = config['frigate'].get('max_queued_events', 20)
+    while len(work_queue) >= max_queued_events:
+        dropped = work_queue.popleft()
+        dropped['in_flight'] = False
+        dropped['next_attempt'] = get_next_attempt_time()
+        SCHEDULER_STATS['dropped'] += 1
+        _LOGGER.debug(f"Recognition queue full, dropped attempt for event {dropped['id']}")
+    event['in_flight'] = True
+    event['next_attempt'] = None
+    work_queue.append(event)
+    SCHEDULER_STATS['queued'] += 1
+    work_condition.notify()
+
+def get_next_attempt_time():
+    attempt_interval = config['frigate'].get('attempt_interval', 0.5)
+    return time.monotonic() + attempt_interval if attempt_interval else None
+
+def schedule_due_events():
+    # must be called with events_lock held, returns the seconds until the next event is due
+    now = time.monotonic()
+    max_attempts = config['frigate'].get('max_attempts')
+    next_wakeup = 1.0
+    for event in list(CURRENT_EVENTS.values()):
+        if event['in_flight']:
+            continue
+        if max_attempts and event['attempts'] >= max_attempts:
+            finish_event(event, "max attempts reached")
+        elif event['deadline'] is not None and now >= event['deadline']:
+            finish_event(event, "deadline reached")
+        elif event['next_attempt'] is not None:
+            if event['next_attempt'] <= now:
+                readability = check_readability(event['after_data'])
+                if readability == 'now':
+                    enqueue_event(event)
+                elif readability == 'never':
+                    finish_event(event, "plate not readable")
+                else:
+                    # wait for a frigate update with a better view of the object
+                    event['next_attempt'] = None
+            else:
+                next_wakeup = min(next_wakeup, event['next_attempt'] - now)
+    return next_wakeup
+
+def run_event_scheduler(stopped):
+    with events_lock:
+        while not stopped.is_set():
+            next_wakeup = schedule_due_events()
+            scheduler_condition.wait(timeout=next_wakeup)
+
+def run_recognition_worker(stopped):
+    while True:
+        with events_lock:
+            while not work_queue and not stopped.is_set():
+                work_condition.wait()
+            if stopped.is_set():
+                return
+            event = work_queue.popleft()
+        done = False
+        trace_attempt(event['id'])
+        try:
+            done = run_traced(event['id'], process_events, event['after_data'], event['frigate_url'], event['id'])
+        except Exception as e:
+            _LOGGER.error(f"Failed to process event {event['id']}: {e}")
+        complete_attempt(event, done)
+
+def complete_attempt(event, done):
+    with events_lock:
+        event['in_flight'] = False
+        event['attempts'] += 1
+        SCHEDULER_STATS['attempts'] += 1
+        if event['cancelled']:
+            return
+        if done:
+            finish_event(event, "plate resolved")
+            return
+        event['next_attempt'] = get_next_attempt_time()
+        scheduler_condition.notify()
+
+def get_scheduler_stats():
+    with events_lock:
+        return dict(SCHEDULER_STATS, active_events=len(CURRENT_EVENTS), queue_depth=len(work_queue))
+
+def start_event_scheduler():
+    global scheduler_stopped
+    scheduler_stopped = threading.Event()
+    threads = [threading.Thread(target=run_event_scheduler, args=(scheduler_stopped,), daemon=True)]
+    for _ in range(config['frigate'].get('recognition_workers', 10)):
+        threads.append(threading.Thread(target=run_recognition_worker, args=(scheduler_stopped,), daemon=True))
+    for thread in threads:
         thread.start()
+    return threads
 
-def process_event(before_data, after_data, frigate_url, frigate_event_id):
-    global event_type
-    loop = 0
-    while event_type in ["update", "new"] and not is_plate_found_for_event(frigate_event_id):
-        loop=loop + 1
-        timestamp = datetime.now()
-        print(f"{timestamp} start processing loop {loop} for {frigate_event_id}")
-        executor.submit(process_events , after_data, frigate_url, frigate_event_id)
-        time.sleep(0.5)
-
-    print(f"Done processing event {frigate_event_id}, {event_type}")
+def stop_event_scheduler(threads=()):
+    with events_lock:
+        scheduler_stopped.set()
+        scheduler_condition.notify_all()
+        work_condition.notify_all()
+    for thread in threads:
+        thread.join()
 
 def process_events(after_data, frigate_url, frigate_event_id):
-    timestamp = datetime.now()
-    print(f"{timestamp} start processing event {frigate_event_id}")
-    snapshot = get_latest_snapshot(frigate_event_id, frigate_url, after_data['camera'])
+    _LOGGER.debug(f"Start processing event {frigate_event_id}")
+    snapshot = get_snapshot(frigate_event_id, after_data['camera'])
+    return recognize_snapshot(after_data, frigate_url, frigate_event_id, snapshot)
+
+def recognize_snapshot(after_data, frigate_url, frigate_event_id, snapshot):
+    if snapshot is None:
+        return False
+    frame = snapshot if isinstance(snapshot, Frame) else Frame(snapshot)
+    if is_duplicate_frame(frigate_event_id, frame, after_data):
+        _LOGGER.debug(f"Skipping unchanged frame for event {frigate_event_id}")
+        return False
 
     if not is_plate_found_for_event(frigate_event_id):
-        detected_plate_number, detected_plate_score = get_plate(snapshot)
-        watched_plate, fuzzy_score = check_watched_plates(detected_plate_number)
+        detected_plate_number, detected_plate_score = get_plate(frame, after_data)
+        if not detected_plate_number:
+            return False
+        consensus = add_plate_read(frigate_event_id, detected_plate_number, detected_plate_score)
+        detected_plate_number, detected_plate_score = consensus['plate'], consensus['score']
+        with stage('fuzzy_match'):
+            watched_plate, fuzzy_score = check_watched_plates(detected_plate_number)
 
         if watched_plate is not None and fuzzy_score is not None:
-            start_time = datetime.fromtimestamp(after_data['start_time'])
-            formatted_start_time = start_time.strftime("%Y-%m-%d %H:%M:%S")
-            print(f"{datetime.now()} storing plate({detected_plate_number}) in db")
-            store_plate_in_db(formatted_start_time, detected_plate_number, fuzzy_score, frigate_event_id,after_data['camera'], watched_plate, True)
-            print(f"{datetime.now()} saving  plate({detected_plate_number}) image")
-            image_path = save_image(config,detected_plate_score,snapshot,after_data,frigate_url,frigate_event_id,plate_number=detected_plate_number)
-            print(f"{datetime.now()} sending mqtt message for  plate({detected_plate_number})")
-            send_mqtt_message(detected_plate_number, detected_plate_score, frigate_event_id, after_data, watched_plate,config['frigate'].get('watched_plates'),  fuzzy_score,image_path)
-            executor.submit(delete_old_files)
-            print(f"plate({detected_plate_number}) match found in watched plates ({watched_plate}) for event {frigate_event_id}, {event_type} stops")
+            report_watched_plate(frame, after_data, frigate_url, frigate_event_id, detected_plate_number, detected_plate_score, watched_plate, fuzzy_score)
+            return True
+        if consensus['converged']:
+            _LOGGER.info(f"Plate {detected_plate_number} agreed on by {consensus['votes']} frames is not watched, event {frigate_event_id} stops")
+            return True
+        return False
     else:
-        print(f"plate already found for event {frigate_event_id}, {event_type} skipping........")
+        print(f"plate already found for event {frigate_event_id}, skipping........")
+        return True
 
 
-def get_alpr():
-    plate_detector_model = config['fast_alpr'].get('plate_detector_model')
-    ocr_model = config['fast_alpr'].get('ocr_model')
-    return ALPR(
-        detector_model=plate_detector_model,
-        ocr_model=ocr_model,ocr_device="cpu",ocr_model_path=CONFIG_PATH + "/models"
-    )
-def fast_alpr(snapshot):
-    plate_detector_model = config['fast_alpr'].get('plate_detector_model')
-    ocr_model = config['fast_alpr'].get('ocr_model')
+def get_consensus_plate(plate_reads):
+    # the most supported plate length wins, then each character position is voted on weighted by OCR confidence.
+    # When all confidences are 0 the reads are counted as plain votes
+    length_weights = collections.defaultdict(float)
+    for text, confidences in plate_reads:
+        length_weights[len(text)] += statistics.mean(confidences)
+    if not sum(length_weights.values()):
+        length_weights = collections.Counter(len(text) for text, _ in plate_reads)
+    plate_length = max(length_weights, key=length_weights.get)
+    votes = [(text, confidences) for text, confidences in plate_reads if len(text) == plate_length]
+
+    plate = []
+    agreement = []
+    for position in range(plate_length):
+        char_weights = collections.defaultdict(float)
+        for text, confidences in votes:
+            char_weights[text[position]] += confidences[position]
+        if not sum(char_weights.values()):
+            char_weights = collections.Counter(text[position] for text, _ in votes)
+        char = max(char_weights, key=char_weights.get)
+        plate.append(char)
+        agreement.append(char_weights[char] / sum(char_weights.values()))
+
+    min_votes = config['fast_alpr'].get('vote_min_frames', 3)
+    threshold = config['fast_alpr'].get('vote_threshold', 0.7)
+    return {
+        'plate': ''.join(plate),
+        'score': statistics.mean(statistics.mean(confidences) for _, confidences in votes),
+        'agreement': min(agreement),
+        'votes': len(votes),
+        'converged': len(votes) >= min_votes and min(agreement) >= threshold,
+    }
+
+def add_plate_read(frigate_event_id, plate_number, plate_score):
+    text = str(plate_number).upper()
+    if isinstance(plate_score, list) and len(plate_score) == len(text):
+        confidences = [float(c) for c in plate_score]
+    else:
+        confidences = [float(statistics.mean(plate_score) if isinstance(plate_score, list) else plate_score)] * len(text)
+    with plate_reads_lock:
+        plate_reads = PLATE_READS.setdefault(frigate_event_id, [])
+        plate_reads.append((text, confidences))
+        consensus = get_consensus_plate(plate_reads)
+    _LOGGER.debug(f"Consensus for event {frigate_event_id} after {len(plate_reads)} reads: {consensus}")
+    return consensus
+
+def get_frame_thumbnail(frame, after_data):
+    crop_box = get_crop_box(frame, after_data)
+    image = frame.crop(*crop_box).image if crop_box else frame.image
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA)
+
+def is_duplicate_frame(frigate_event_id, frame, after_data):
+    # compare against the last frame that was run through ALPR for this event
+    if not config['frigate'].get('frame_dedup', True):
+        return False
+    with last_frames_lock:
+        last_frame = LAST_FRAMES.get(frigate_event_id)
+
+    digest = hashlib.sha1(frame.data).digest() if frame.data is not None else None
+    if last_frame is not None and digest is not None and digest == last_frame['digest']:
+        with last_frames_lock:
+            FRAME_DEDUP_STATS['exact'] += 1
+        return True
+
+    thumbnail = get_frame_thumbnail(frame, after_data)
+    if last_frame is not None and thumbnail.shape == last_frame['thumbnail'].shape:
+        difference = float(np.mean(cv2.absdiff(thumbnail, last_frame['thumbnail'])))
+        if difference < config['frigate'].get('frame_diff_threshold', 2.0):
+            with last_frames_lock:
+                FRAME_DEDUP_STATS['similar'] += 1
+            return True
+
+    with last_frames_lock:
+        LAST_FRAMES[frigate_event_id] = {'digest': digest, 'thumbnail': thumbnail}
+        FRAME_DEDUP_STATS['processed'] += 1
+    return False
+
+def forget_event_state(frigate_event_id):
+    with last_frames_lock:
+        LAST_FRAMES.pop(frigate_event_id, None)
+    with plate_reads_lock:
+        PLATE_READS.pop(frigate_event_id, None)
+
+def get_frame_dedup_stats():
+    with last_frames_lock:
+        return dict(FRAME_DEDUP_STATS)
+
+def get_rss_bytes():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def get_alpr_model_key(fast_alpr_config):
+    return fast_alpr_config.get('plate_detector_model'), fast_alpr_config.get('ocr_model')
+
+def load_alpr(fast_alpr_config):
+    plate_detector_model, ocr_model = get_alpr_model_key(fast_alpr_config)
+    rss_before = get_rss_bytes()
+    start_time = time.perf_counter()
+    session_options = {}
+    if fast_alpr_config.get('intra_op_threads'):
+        sess_options = onnxruntime.SessionOptions()
+        sess_options.intra_op_num_threads = fast_alpr_config['intra_op_threads']
+        session_options = {'detector_sess_options': sess_options, 'ocr_sess_options': sess_options}
     alpr = ALPR(
         detector_model=plate_detector_model,
-        ocr_model=ocr_model,ocr_device="cpu",ocr_model_path=CONFIG_PATH + "/models"
+        ocr_model=ocr_model,ocr_device="cpu",ocr_model_path=CONFIG_PATH + "/models",
+        **session_options
     )
+    ALPR_MODEL_STATS[(plate_detector_model, ocr_model)] = {
+        'load_time': time.perf_counter() - start_time,
+        'memory_bytes': max(get_rss_bytes() - rss_before, 0),
+        'loaded_at': datetime.now().strftime(DATETIME_FORMAT),
+    }
+    stats = ALPR_MODEL_STATS[(plate_detector_model, ocr_model)]
+    _LOGGER.info(f"Loaded ALPR models {plate_detector_model}/{ocr_model} in {stats['load_time']:.2f}s "
+                 f"using {stats['memory_bytes'] / 1048576:.1f}MB")
+    # ALPR.predict calls the models through these attributes, so detection and OCR are timed separately
+    alpr.detector.predict = timed('detection', alpr.detector.predict)
+    alpr.ocr.predict = timed('ocr', alpr.ocr.predict)
+    return alpr
 
-    image_array = np.frombuffer(snapshot, np.uint8)
-    frame = cv2.imdecode(image_array, cv2.IMREAD_COLOR)
+def get_alpr():
+    # onnxruntime sessions are safe to run concurrently, so one instance per model pair is shared by all threads
+    key = get_alpr_model_key(config['fast_alpr'])
+    alpr = ALPR_MODELS.get(key)
+    if alpr is None:
+        with alpr_models_lock:
+            # a config reload may have swapped the models since the key was read
+            key = get_alpr_model_key(config['fast_alpr'])
+            alpr = ALPR_MODELS.get(key)
+            if alpr is None:
+                alpr = load_alpr(config['fast_alpr'])
+                ALPR_MODELS[key] = alpr
+    return alpr
+
+def preload_alpr_models(fast_alpr_config):
+    key = get_alpr_model_key(fast_alpr_config)
+    if key not in ALPR_MODELS:
+        # load outside of the lock so recognition keeps using the old models until the new ones are ready
+        alpr = load_alpr(fast_alpr_config)
+        with alpr_models_lock:
+            ALPR_MODELS[key] = alpr
+
+def unload_stale_alpr_models():
+    # only called once config has the new models, so get_alpr cannot load the old ones again
+    key = get_alpr_model_key(config['fast_alpr'])
+    with alpr_models_lock:
+        for stale_key in [k for k in ALPR_MODELS if k != key]:
+            del ALPR_MODELS[stale_key]
+            ALPR_MODEL_STATS.pop(stale_key, None)
+            _LOGGER.info(f"Unloaded ALPR models {stale_key[0]}/{stale_key[1]}")
+
+def get_alpr_model_stats():
+    return {f"{detector}/{ocr}": dict(stats) for (detector, ocr), stats in ALPR_MODEL_STATS.items()}
+
+class Frame:
+    # a snapshot flowing through the pipeline, decoded and encoded at most once
+    def __init__(self, data=None, image=None):
+        self.data = data
+        self._image = image
+        self.results = []
+        self._encoded = {}
+
+    @property
+    def image(self):
+        if self._image is None and self.data is not None:
+            with stage('decode'):
+                self._image = cv2.imdecode(np.frombuffer(self.data, np.uint8), cv2.IMREAD_COLOR)
+        return self._image
+
+    def encode(self, extension='.png', params=()):
+        key = (extension, tuple(params))
+        if key not in self._encoded:
+            success, buffer = cv2.imencode(extension, self.image, list(params))
+            if not success:
+                raise ValueError(f"Failed to encode frame as {extension}")
+            self._encoded[key] = buffer.tobytes()
+        return self._encoded[key]
+
+    def crop(self, x1, y1, x2, y2):
+        return Frame(image=self.image[y1:y2, x1:x2])
+
+def draw_alpr_results(image, alpr_results):
+    # same drawing as ALPR.draw_predictions, without running the models again
+    for result in alpr_results:
+        bbox = result.detection.bounding_box
+        cv2.rectangle(image, (bbox.x1, bbox.y1), (bbox.x2, bbox.y2), (36, 255, 12), 2)
+        if result.ocr is None or not result.ocr.text or not result.ocr.confidence:
+            continue
+        confidence = statistics.mean(result.ocr.confidence) if isinstance(result.ocr.confidence, list) else result.ocr.confidence
+        display_text = f"{result.ocr.text} {confidence * 100:.2f}%"
+        for color, thickness in (((0, 0, 0), 6), ((255, 255, 255), 2)):
+            cv2.putText(image, display_text, (bbox.x1, bbox.y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 1.25, color, thickness, cv2.LINE_AA)
+    return image
+
+def annotate_frame(frame):
+    return Frame(image=draw_alpr_results(frame.image.copy(), frame.results))
+
+def get_object_box(after_data):
+    snapshot_config = get_snapshot_config(after_data['camera'])
+    source = snapshot_config.get('source', 'latest')
+    if source in ('latest', 'stream'):
+        return after_data.get('box')
+    if snapshot_config.get('crop'):
+        # frigate already cropped the snapshot to the object
+        return None
+    return (after_data.get('snapshot') or {}).get('box')
+
+def scale_to_frame(box, frame, camera_name):
+    # frigate boxes are relative to the detect resolution of the camera
+    detect_resolution = config['frigate'].get('detect_resolution', {}).get(camera_name)
+    if not detect_resolution:
+        return box
+    frame_height, frame_width = frame.image.shape[:2]
+    scale_x, scale_y = frame_width / detect_resolution[0], frame_height / detect_resolution[1]
+    return [box[0] * scale_x, box[1] * scale_y, box[2] * scale_x, box[3] * scale_y]
+
+def get_crop_box(frame, after_data):
+    box = get_object_box(after_data)
+    if not box:
+        return None
+    frame_height, frame_width = frame.image.shape[:2]
+    box = scale_to_frame(box, frame, after_data['camera'])
+
+    padding = config['fast_alpr'].get('crop_padding', 0.2)
+    min_size = config['fast_alpr'].get('crop_min_size', 256)
+    box_width, box_height = box[2] - box[0], box[3] - box[1]
+    crop_width = min(max(box_width * (1 + 2 * padding), min_size), frame_width)
+    crop_height = min(max(box_height * (1 + 2 * padding), min_size), frame_height)
+    center_x, center_y = (box[0] + box[2]) / 2, (box[1] + box[3]) / 2
+
+    x1 = int(min(max(center_x - crop_width / 2, 0), frame_width - crop_width))
+    y1 = int(min(max(center_y - crop_height / 2, 0), frame_height - crop_height))
+    x2, y2 = int(x1 + crop_width), int(y1 + crop_height)
+    if (x2 - x1) * (y2 - y1) >= frame_width * frame_height:
+        return None
+    return x1, y1, x2, y2
+
+def offset_alpr_results(alpr_results, x, y):
+    offset_results = []
+    for result in alpr_results:
+        bbox = result.detection.bounding_box
+        bbox = BoundingBox(x1=bbox.x1 + x, y1=bbox.y1 + y, x2=bbox.x2 + x, y2=bbox.y2 + y)
+        offset_results.append(dataclasses.replace(result, detection=dataclasses.replace(result.detection, bounding_box=bbox)))
+    return offset_results
+
+def get_license_plate_attribute(after_data):
+    if not config['frigate'].get('frigate_plus', False):
+        return None
+    return [attribute for attribute in after_data.get('current_attributes') or [] if attribute.get('label') == 'license_plate']
+
+def is_valid_license_plate(after_data):
+    license_plate_attribute = get_license_plate_attribute(after_data)
+    if not license_plate_attribute:
+        _LOGGER.debug("no license_plate attribute found in event attributes")
+        return False
+    score = max(attribute['score'] for attribute in license_plate_attribute)
+    if score < config['frigate'].get('license_plate_min_score', 0):
+        _LOGGER.debug(f"license_plate attribute score is below minimum: {score}")
+        return False
+    return True
+
+def get_plate_attribute_box(frame, after_data):
+    # frigate+ attribute boxes are for the live frame, so they only match latest.jpg and stream snapshots
+    if get_snapshot_config(after_data['camera']).get('source', 'latest') not in ('latest', 'stream') or not is_valid_license_plate(after_data):
+        return None
+    attribute = max(get_license_plate_attribute(after_data), key=lambda attribute: attribute['score'])
+    box = attribute.get('box')
+    if not box:
+        return None
+    frame_height, frame_width = frame.image.shape[:2]
+    box = scale_to_frame(box, frame, after_data['camera'])
+    padding = config['fast_alpr'].get('plate_padding', 0.1)
+    pad_x, pad_y = (box[2] - box[0]) * padding, (box[3] - box[1]) * padding
+    x1, y1 = int(max(box[0] - pad_x, 0)), int(max(box[1] - pad_y, 0))
+    x2, y2 = int(min(box[2] + pad_x, frame_width)), int(min(box[3] + pad_y, frame_height))
+    if x2 <= x1 or y2 <= y1:
+        return None
+    return (x1, y1, x2, y2), attribute['score']
+
+def predict_plate_attribute(frame, after_data):
+    # the plate was already found by frigate+, so only the OCR model has to run
+    plate_box = get_plate_attribute_box(frame, after_data)
+    if plate_box is None:
+        return []
+    (x1, y1, x2, y2), score = plate_box
+    ocr_result = run_ocr(frame.crop(x1, y1, x2, y2).image)
+    if ocr_result is None or not ocr_result.text:
+        return []
+    detection = DetectionResult(label='license_plate', confidence=score, bounding_box=BoundingBox(x1=x1, y1=y1, x2=x2, y2=y2))
+    return [ALPRResult(detection=detection, ocr=ocr_result)]
+
+def get_plate_crops(image, detections):
+    plates = []
+    for detection in detections:
+        bbox = detection.bounding_box
+        x1, y1 = max(bbox.x1, 0), max(bbox.y1, 0)
+        x2, y2 = min(bbox.x2, image.shape[1]), min(bbox.y2, image.shape[0])
+        plates.append(image[y1:y2, x1:x2])
+    return plates
+
+def read_plates(plates):
+    # all plate crops go through the OCR model in one run
+    alpr = get_alpr()
+    if not plates:
+        return []
+    if hasattr(alpr.ocr, 'ocr_model'):
+        gray_plates = [cv2.cvtColor(plate, cv2.COLOR_BGR2GRAY) for plate in plates]
+        with stage('ocr'):
+            plate_texts, probabilities = alpr.ocr.ocr_model.run(gray_plates, return_confidence=True)
+        # fast_plate_ocr uses '_' padding symbol
+        return [OcrResult(text=text.replace("_", ""), confidence=float(np.mean(plate_probabilities)))
+                for text, plate_probabilities in zip(plate_texts, probabilities)]
+    return [alpr.ocr.predict(plate) for plate in plates]
+
+def predict_batch(images):
+    # same as ALPR.predict, but the plates found in all images go through the OCR model in one batch
+    alpr = get_alpr()
+    detections = [alpr.detector.predict(image) for image in images]
+    plates = [plate for image, image_detections in zip(images, detections) for plate in get_plate_crops(image, image_detections)]
+    ocr_results = iter(read_plates(plates))
+    return [[ALPRResult(detection=detection, ocr=next(ocr_results)) for detection in image_detections]
+            for image_detections in detections]
+
+class InferenceBatcher:
+    # plate detection runs in the recognition workers, the plate crops of all events are read in micro batches
+    # by a single OCR thread
+    def __init__(self, max_batch_size, max_wait):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, plates):
+        future = concurrent.futures.Future()
+        with self.lock:
+            if not self.stopped:
+                self.queue.put((plates, future))
+                return future
+        future.set_exception(RuntimeError("Inference batcher stopped"))
+        return future
+
+    def predict(self, image):
+        detections = get_alpr().detector.predict(image)
+        if not detections:
+            return []
+        ocr_results = self.submit(get_plate_crops(image, detections)).result()
+        return [ALPRResult(detection=detection, ocr=ocr_result) for detection, ocr_result in zip(detections, ocr_results)]
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self.queue.put(None)
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            plate_count = len(item[0])
+            flush_at = time.monotonic() + self.max_wait
+            while plate_count < self.max_batch_size:
+                try:
+                    item = self.queue.get(timeout=max(flush_at - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+                plate_count += len(item[0])
+            try:
+                ocr_results = read_plates([plate for plates, _ in batch for plate in plates])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for plates, future in batch:
+                future.set_result(ocr_results[:len(plates)])
+                ocr_results = ocr_results[len(plates):]
+
+        # nothing is queued after the sentinel, this only guards against a waiter hanging forever
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                item[1].set_exception(RuntimeError("Inference batcher stopped"))
 
-    alpr_results = get_alpr().predict(frame)
+def get_available_cores():
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
 
-    print(alpr_results)
+def init_inference_process(process_config):
+    global config, _LOGGER
+    config = process_config
+    _LOGGER = logging.getLogger(__name__)
+    get_alpr()
+
+def predict_shared_frame(shm_name, shape, dtype):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    image = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    try:
+        return get_alpr().predict(image)
+    finally:
+        # the view has to be released before the shared memory can be closed
+        del image
+        shm.close()
+
+def predict_ocr(image):
+    return get_alpr().ocr.predict(image)
+
+def run_ocr(image):
+    # plate crops are small enough to be pickled to the worker process
+    if process_pool is not None:
+        return run_in_process_pool(predict_ocr, image)
+    return predict_ocr(image)
+
+def create_process_pool():
+    workers = config['fast_alpr'].get('process_workers') or get_available_cores()
+    process_config = copy.deepcopy(config)
+    # keep each worker process to its share of the cores
+    process_config['fast_alpr'].setdefault('intra_op_threads', max(get_available_cores() // workers, 1))
+    _LOGGER.info(f"Running ALPR in {workers} worker processes")
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=init_inference_process,
+        initargs=(process_config,),
+    )
 
-    for result in alpr_results:
+def get_process_pool():
+    global process_pool
+    with process_pool_lock:
+        retry_at = PROCESS_POOL_STATE['retry_at']
+        if retry_at is not None:
+            if time.monotonic() < retry_at:
+                raise RuntimeError(f"ALPR worker processes failed, restarting them in {retry_at - time.monotonic():.0f}s")
+            PROCESS_POOL_STATE['retry_at'] = None
+            process_pool = create_process_pool()
+        return process_pool
+
+def on_broken_process_pool(pool):
+    # a worker that fails to start or dies breaks the whole pool, it is started again with an increasing delay
+    with process_pool_lock:
+        if pool is not process_pool or PROCESS_POOL_STATE['retry_at'] is not None:
+            return
+        PROCESS_POOL_STATE['failures'] += 1
+        delay = min(2 ** PROCESS_POOL_STATE['failures'], 300)
+        PROCESS_POOL_STATE['retry_at'] = time.monotonic() + delay
+    pool.shutdown(wait=False)
+    _LOGGER.error(f"ALPR worker processes failed, restarting them in {delay}s")
+
+def run_in_process_pool(fn, *args):
+    pool = get_process_pool()
+    try:
+        result = pool.submit(fn, *args).result()
+    except concurrent.futures.BrokenExecutor:
+        on_broken_process_pool(pool)
+        raise
+    PROCESS_POOL_STATE['failures'] = 0
+    return result
+
+def run_alpr_in_process(image):
+    # frames are copied once into shared memory instead of being pickled to the worker process
+    shm = shared_memory.SharedMemory(create=True, size=max(image.nbytes, 1))
+    try:
+        np.ndarray(image.shape, dtype=image.dtype, buffer=shm.buf)[:] = image
+        return run_in_process_pool(predict_shared_frame, shm.name, image.shape, image.dtype.str)
+    finally:
+        shm.close()
+        shm.unlink()
+
+def is_process_inference(app_config):
+    return app_config['fast_alpr'].get('inference_mode', 'thread') == 'process'
+
+def setup_inference(restart_pool=True):
+    global inference_batcher, process_pool
+    if inference_batcher is not None:
+        inference_batcher.stop()
+        inference_batcher = None
+    if process_pool is not None and (restart_pool or not is_process_inference(config)):
+        with process_pool_lock:
+            pool = process_pool
+            process_pool = None
+            PROCESS_POOL_STATE.update(failures=0, retry_at=None)
+        pool.shutdown(wait=False)
+
+    if is_process_inference(config):
+        if process_pool is None:
+            process_pool = create_process_pool()
+        return
+
+    batch_size = config['fast_alpr'].get('batch_size', 1)
+    if batch_size > 1:
+        inference_batcher = InferenceBatcher(batch_size, config['fast_alpr'].get('batch_wait_ms', 10) / 1000)
+
+def run_alpr(image):
+    if process_pool is not None:
+        return run_alpr_in_process(image)
+    if inference_batcher is not None:
+        return inference_batcher.predict(image)
+    return get_alpr().predict(image)
+
+def predict_plates(frame, after_data):
+    if config['frigate'].get('frigate_plus', False):
+        alpr_results = predict_plate_attribute(frame, after_data)
+        if alpr_results:
+            return alpr_results
+        _LOGGER.debug(f"No plate read from frigate+ attribute of event {after_data['id']}, running plate detection")
+    if config['fast_alpr'].get('crop_to_object', False):
+        crop_box = get_crop_box(frame, after_data)
+        if crop_box:
+            alpr_results = run_alpr(frame.crop(*crop_box).image)
+            if alpr_results:
+                return offset_alpr_results(alpr_results, crop_box[0], crop_box[1])
+            _LOGGER.debug(f"No plate found in object box of event {after_data['id']}, trying full frame")
+    return run_alpr(frame.image)
+
+def fast_alpr(frame, after_data):
+    frame.results = predict_plates(frame, after_data)
+
+    _LOGGER.debug(f"ALPR results for event {after_data['id']}: {frame.results}")
+
+    ocr_text = None
+    ocr_confidence = None
+    for result in frame.results:
         ocr_text = result.ocr.text
         ocr_confidence = result.ocr.confidence
 
     return ocr_text, ocr_confidence
 
+def normalize_plate(plate_number):
+    # fold characters that OCR commonly confuses so O/0, I/1, B/8... compare equal
+    return ''.join(c for c in str(plate_number).upper() if c.isalnum()).translate(OCR_CONFUSIONS)
+
+def levenshtein_distance(a, b):
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+def get_plate_bigrams(normalized):
+    # padded bigrams tagged with their occurrence, so set intersection counts shared bigrams as a multiset
+    padded = f"^{normalized}$"
+    seen = collections.Counter()
+    bigrams = []
+    for i in range(len(padded) - 1):
+        bigram = padded[i:i + 2]
+        bigrams.append((bigram, seen[bigram]))
+        seen[bigram] += 1
+    return bigrams
+
+class PlateMatcher:
+    # exact lookups through a dict, fuzzy lookups through a bigram index of the normalized watched plates
+    def __init__(self, watched_plates):
+        self.plates = collections.defaultdict(list)
+        for watched_plate in watched_plates:
+            self.plates[normalize_plate(watched_plate)].append(str(watched_plate))
+        self.normalized = list(self.plates)
+        self.index = collections.defaultdict(list)
+        for plate_id, normalized in enumerate(self.normalized):
+            for bigram in get_plate_bigrams(normalized):
+                self.index[bigram].append(plate_id)
+
+    def __len__(self):
+        return sum(len(plates) for plates in self.plates.values())
+
+    def _search(self, normalized, radius):
+        # each edit changes at most two bigrams, so a plate within radius edits shares at least
+        # len + 1 - 2 * radius bigrams with the query
+        if len(normalized) + 1 - 2 * radius <= 0:
+            candidates = range(len(self.normalized))
+        else:
+            shared = collections.Counter()
+            for bigram in get_plate_bigrams(normalized):
+                shared.update(self.index.get(bigram, ()))
+            min_shared = len(normalized) + 1 - 2 * radius
+            candidates = [plate_id for plate_id, count in shared.items() if count >= min_shared]
+
+        found = []
+        for plate_id in candidates:
+            candidate = self.normalized[plate_id]
+            if abs(len(candidate) - len(normalized)) > radius:
+                continue
+            distance = levenshtein_distance(normalized, candidate)
+            if distance <= radius:
+                found.append((candidate, distance))
+        return found
+
+    def match(self, plate_number, min_score=1.0, top_k=1):
+        normalized = normalize_plate(plate_number)
+        if not normalized:
+            return []
+        if min_score >= 1:
+            candidates = [(normalized, 0)] if normalized in self.plates else []
+        else:
+            # a candidate scoring at least min_score is at most this many edits away, the tolerance keeps
+            # candidates that score exactly min_score despite float rounding
+            radius = math.floor(len(normalized) * (1 - min_score) / max(min_score, 0.01) + 1e-9)
+            candidates = self._search(normalized, radius)
+
+        matches = []
+        for candidate, distance in candidates:
+            score = 1 - distance / max(len(normalized), len(candidate))
+            if score >= min_score:
+                matches.extend((watched_plate, score) for watched_plate in self.plates[candidate])
+        matches.sort(key=lambda match: match[1], reverse=True)
+        return matches[:top_k]
+
+def build_watched_plate_matcher():
+    global watched_plate_matcher
+    watched_plate_matcher = PlateMatcher(config['frigate'].get('watched_plates') or [])
+
 def check_watched_plates(plate_number):
-    config_watched_plates = config['frigate'].get('watched_plates', [])
-    if not config_watched_plates:
+    if watched_plate_matcher is None:
+        build_watched_plate_matcher()
+    if not len(watched_plate_matcher):
         _LOGGER.debug("Skipping checking Watched Plates because watched_plates is not set")
-        return None, None, None
-    
-    config_watched_plates = [str(x).lower() for x in config_watched_plates] #make sure watched_plates are all lower case
-    
+        return None, None
+
     #Step 1 - test if top plate is a watched plate
-    matching_plate = str(plate_number).lower() in config_watched_plates 
-    if matching_plate:
+    matches = watched_plate_matcher.match(plate_number)
+    if matches:
         _LOGGER.info(f"Recognised plate is a Watched Plate: {plate_number}")
-        return None, None, None  
+        return matches[0]
+
+    fuzzy_match = config['frigate'].get('fuzzy_match', 0)
 
-    fuzzy_match = config['frigate'].get('fuzzy_match', 0) 
-    
     if fuzzy_match == 0:
         _LOGGER.debug(f"Skipping fuzzy matching because fuzzy_match value not set in config")
-        return None, None, None
-    
-    max_score = 0
-    best_match = None
-    for watched_plate in config_watched_plates:
-        seq = difflib.SequenceMatcher(a=str(plate_number).lower(), b=str(watched_plate).lower())
-        if seq.ratio() > max_score: 
-            max_score = seq.ratio()
-            best_match = watched_plate
-    
-    _LOGGER.debug(f"Best fuzzy_match: {best_match} ({max_score})")
-
-    if max_score >= fuzzy_match:
-        _LOGGER.info(f"Watched plate found from fuzzy matching: {best_match} with score {max_score}")    
+        return None, None
+
+    matches = watched_plate_matcher.match(plate_number, fuzzy_match, config['frigate'].get('fuzzy_match_top_k', 3))
+    _LOGGER.debug(f"Best fuzzy_matches for {plate_number}: {matches}")
+
+    if matches:
+        best_match, max_score = matches[0]
+        _LOGGER.info(f"Watched plate found from fuzzy matching: {best_match} with score {max_score}")
         return best_match, max_score
 
     return None, None
-    
-def send_mqtt_message(plate_number, plate_score, frigate_event_id, after_data, watched_plate, watched_plates, fuzzy_score, image_path):
-    timestamp = datetime.now().strftime(DATETIME_FORMAT)
-    vehicle_data = {
-        'fuzzy_score': round(fuzzy_score,2),
-        'matched': False,
-        'detected_plate_number': str(plate_number).upper(),
-        'detected_plate_ocr_score': round(plate_score,2),
-        'frigate_event_id': frigate_event_id,
-        'watched_plates': json.dumps(watched_plates),
-        'camera_name': after_data['camera'],
-        "plate_image": image_path,
-        'watched_plate': str(watched_plate).upper()
-
-    }
 
-    vehicle_data['matched'] = vehicle_data['fuzzy_score'] > 0.8
+def get_homeassistant_config():
+    return config.get('homeassistant') or {}
 
-    def encode_image_to_base64(image_path):
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode("utf-8")
-    vehicle_data['plate_image'] = encode_image_to_base64(image_path)
+def get_vehicle_data_topics(key):
+    prefix = get_homeassistant_config().get('discovery_prefix', 'homeassistant')
+    component = VEHICLE_DATA_COMPONENTS.get(key, 'sensor')
+    discovery_topic = f"{prefix}/{component}/vehicle_data/{key}/config"
+    if get_homeassistant_config().get('json_state', False) and component != 'camera':
+        return discovery_topic, f"{prefix}/sensor/vehicle_data/state"
+    return discovery_topic, f"{prefix}/{component}/vehicle_data/{key}/state"
 
+def get_discovery_payloads():
+    json_state = get_homeassistant_config().get('json_state', False)
     device_config = {
         "name": "Plate Detection",
         "identifiers": "License Plate Detection",
@@ -228,12 +1254,11 @@ def send_mqtt_message(plate_number, plate_score, frigate_event_id, after_data, w
         "sw_version": "1.0"
     }
 
-    for key, value in vehicle_data.items():
+    discovery_payloads = []
+    for key in VEHICLE_DATA_KEYS:
+        discovery_topic, state_topic = get_vehicle_data_topics(key)
         if key == "matched":
             # Binary Sensor Configuration
-            discovery_topic = f"homeassistant/binary_sensor/vehicle_data/{key}/config"
-            state_topic = f"homeassistant/binary_sensor/vehicle_data/{key}/state"
-
             payload = {
                 "name": "matched",
                 "state_topic": state_topic,
@@ -243,26 +1268,14 @@ def send_mqtt_message(plate_number, plate_score, frigate_event_id, after_data, w
                 "unique_id": f"vehicle_binary_sensor_{key}",
                 "device": device_config
             }
-            print(f" {timestamp} sending mqtt on")
-            executor.submit(publish_message, discovery_topic, state_topic, payload, value )
-            executor.submit(reset_binary_sensor_state_after_delay,state_topic, 20, value)
-
-
         elif key == "plate_image":
-            discovery_topic = f"homeassistant/camera/vehicle_data/{key}/config"
-            state_topic = f"homeassistant/camera/vehicle_data/{key}/state"
-
             payload = {
                 "name": "plate image",
                 "state_topic": state_topic,
                 "unique_id": f"vehicle_camera_{key}",
                 "device": device_config
             }
-            executor.submit(publish_message, discovery_topic, state_topic, payload, value )
         else:
-            discovery_topic = f"homeassistant/sensor/vehicle_data/{key}/config"
-            state_topic = f"homeassistant/sensor/vehicle_data/{key}/state"
-
             payload = {
                 "name": f"{key.replace('_', ' ').title()}",
                 "state_topic": state_topic,
@@ -275,37 +1288,207 @@ def send_mqtt_message(plate_number, plate_score, frigate_event_id, after_data, w
             # Adjust unit_of_measurement for specific fields
             if key == "ocr_score":
                 payload["unit_of_measurement"] = "%"
-            executor.submit(publish_message, discovery_topic, state_topic,payload, value )
+        if json_state and key != "plate_image":
+            payload["value_template"] = f"{{{{ value_json.{key} }}}}"
+        discovery_payloads.append((discovery_topic, payload))
+    return discovery_payloads
+
+def publish_discovery(client):
+    # discovery configs are retained, so they only need to be sent once per connection or HA restart
+    qos = get_homeassistant_config().get('qos', 0)
+    for discovery_topic, payload in get_discovery_payloads():
+        client.publish(discovery_topic, json.dumps(payload), qos=qos, retain=True)
+    _LOGGER.debug("Published Home Assistant discovery configs")
+
+def is_homeassistant_status(message):
+    return message.topic == get_homeassistant_config().get('status_topic', 'homeassistant/status')
+
+def on_homeassistant_status(client, message):
+    if message.payload.decode('utf-8', errors='ignore') == 'online':
+        _LOGGER.info("Home Assistant is online, publishing discovery configs")
+        publish_discovery(client)
+
+def send_mqtt_message(plate_number, plate_score, frigate_event_id, after_data, watched_plate, watched_plates, fuzzy_score, image_data):
+    timestamp = datetime.now().strftime(DATETIME_FORMAT)
+    vehicle_data = {
+        'fuzzy_score': round(fuzzy_score,2),
+        'matched': False,
+        'detected_plate_number': str(plate_number).upper(),
+        'detected_plate_ocr_score': round(plate_score,2),
+        'frigate_event_id': frigate_event_id,
+        'watched_plates': json.dumps(watched_plates),
+        'camera_name': after_data['camera'],
+        "plate_image": base64.b64encode(image_data).decode("utf-8"),
+        'watched_plate': str(watched_plate).upper()
 
-def publish_message(discovery_topic, state_topic, payload, value):
-    mqtt_client.publish(discovery_topic, json.dumps(payload), retain=True)
-    mqtt_client.publish(state_topic, value, retain=True)
+    }
 
-def reset_binary_sensor_state_after_delay(state_topic, delay, value):
-    time.sleep(delay)
-    mqtt_client.publish(state_topic, not value, retain=True)
-    print(f"Binary sensor state set to OFF after {delay} seconds.")
+    vehicle_data['matched'] = vehicle_data['fuzzy_score'] > 0.8
 
+    print(f" {timestamp} sending mqtt on")
+    executor.submit(publish_states, vehicle_data)
+    # a new match pushes the pending reset back instead of adding another one
+    matched_topic = get_vehicle_data_topics('matched')[1]
+    if vehicle_data['matched']:
+        delayed_actions.schedule(matched_topic, get_homeassistant_config().get('matched_reset_delay', 20),
+                                 lambda: reset_matched_state(vehicle_data))
+    else:
+        delayed_actions.cancel(matched_topic)
 
+def get_json_state(vehicle_data):
+    return json.dumps({key: value for key, value in vehicle_data.items() if key != 'plate_image'})
 
-def save_image(config,plate_score,snapshot, after_data, frigate_url, frigate_event_id, plate_number):
-    os.makedirs(SNAPSHOT_PATH, exist_ok=True)
+def publish_states(vehicle_data):
+    with stage('mqtt_publish'):
+        publish_vehicle_data(vehicle_data)
+
+def publish_vehicle_data(vehicle_data):
+    qos = get_homeassistant_config().get('qos', 0)
+    if get_homeassistant_config().get('json_state', False):
+        mqtt_client.publish(get_vehicle_data_topics('matched')[1], get_json_state(vehicle_data), qos=qos, retain=True)
+        mqtt_client.publish(get_vehicle_data_topics('plate_image')[1], vehicle_data['plate_image'], qos=qos, retain=True)
+        return
+    for key, value in vehicle_data.items():
+        mqtt_client.publish(get_vehicle_data_topics(key)[1], value, qos=qos, retain=True)
+
+def reset_matched_state(vehicle_data):
+    qos = get_homeassistant_config().get('qos', 0)
+    if get_homeassistant_config().get('json_state', False):
+        payload = get_json_state({**vehicle_data, 'matched': False})
+    else:
+        payload = False
+    mqtt_client.publish(get_vehicle_data_topics('matched')[1], payload, qos=qos, retain=True)
+    _LOGGER.debug("Binary sensor state set to OFF")
+
+class DelayedActions:
+    # runs delayed actions from a single timer thread, scheduling an action under a key that is already pending replaces it
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.heap = []
+        self.pending = {}
+        self.counter = itertools.count()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def schedule(self, key, delay, action):
+        with self.condition:
+            due = time.monotonic() + delay
+            self.pending[key] = (due, action)
+            heapq.heappush(self.heap, (due, next(self.counter), key))
+            self.condition.notify()
+
+    def cancel(self, key):
+        with self.condition:
+            self.pending.pop(key, None)
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def get_next_action(self):
+        with self.condition:
+            while self.running:
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                due, _, key = self.heap[0]
+                pending = self.pending.get(key)
+                # entries for cancelled or rescheduled actions are dropped when they reach the top
+                if pending is None or pending[0] != due:
+                    heapq.heappop(self.heap)
+                    continue
+                delay = due - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                heapq.heappop(self.heap)
+                del self.pending[key]
+                return pending[1]
+            return None
+
+    def run(self):
+        while True:
+            action = self.get_next_action()
+            if action is None:
+                return
+            # actions run on the timer thread and must not block
+            try:
+                action()
+            except Exception as e:
+                _LOGGER.error(f"Delayed action failed: {e}")
+
+
+
+IMAGE_ENCODINGS = {
+    'png': ('.png', cv2.IMWRITE_PNG_COMPRESSION, 'png_compression', 3),
+    'jpg': ('.jpg', cv2.IMWRITE_JPEG_QUALITY, 'quality', 90),
+    'webp': ('.webp', cv2.IMWRITE_WEBP_QUALITY, 'quality', 90),
+}
+
+def encode_image(frame, images_config):
+    image_format = images_config.get('format', 'png')
+    if image_format not in IMAGE_ENCODINGS:
+        raise ValueError(f"Unsupported image format: {image_format}")
+    extension, param, option, default = IMAGE_ENCODINGS[image_format]
+    return extension, frame.encode(extension, (param, images_config.get(option, default)))
+
+def get_image_dir(camera, images_config):
+    if not images_config.get('partition', True):
+        return SNAPSHOT_PATH
+    return os.path.join(SNAPSHOT_PATH, datetime.now().strftime('%Y-%m-%d'), camera)
+
+def write_file_atomic(path, data):
+    # readers and the retention index never see a partly written image
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+
+def get_plate_crop(frame, plate_number, padding=0.1):
+    results = [result for result in frame.results if result.ocr is not None and result.ocr.text == plate_number] or frame.results
+    if not results:
+        return None
+    bbox = max(results, key=lambda result: result.detection.confidence).detection.bounding_box
+    pad_x = int((bbox.x2 - bbox.x1) * padding)
+    pad_y = int((bbox.y2 - bbox.y1) * padding)
+    height, width = frame.image.shape[:2]
+    return frame.crop(max(bbox.x1 - pad_x, 0), max(bbox.y1 - pad_y, 0), min(bbox.x2 + pad_x, width), min(bbox.y2 + pad_y, height))
+
+def get_thumbnail(frame, width):
+    height, frame_width = frame.image.shape[:2]
+    if frame_width <= width:
+        return frame
+    return Frame(image=cv2.resize(frame.image, (width, int(height * width / frame_width)), interpolation=cv2.INTER_AREA))
+
+def save_image(config,plate_score,frame, after_data, frigate_url, frigate_event_id, plate_number):
+    images_config = config.get('images', {})
+    image_dir = get_image_dir(after_data['camera'], images_config)
+    os.makedirs(image_dir, exist_ok=True)
     timestamp = datetime.now().strftime(DATETIME_FORMAT)
-    image_name = f"{after_data['camera']}_{timestamp}.png"
+    image_name = f"{after_data['camera']}_{timestamp}"
     if plate_number:
         image_name = f"{str(plate_number).upper()}_{int(plate_score* 100)}%_{image_name}"
-    image_path = f"{SNAPSHOT_PATH}/{image_name}"
 
-    image_array = np.frombuffer(snapshot, np.uint8)
-    frame = cv2.imdecode(image_array, cv2.IMREAD_COLOR)
-    # frame = cv2.imread(snapshot)
-    annotated_frame = get_alpr().draw_predictions(frame)
-    cv2.imwrite(image_path, annotated_frame)
+    annotated_frame = annotate_frame(frame)
+    plate_crop = get_plate_crop(frame, plate_number) if images_config.get('plate_crop', False) else None
+    if plate_crop is not None:
+        # the plate at full resolution plus a small annotated copy of the frame for context
+        extension, image_data = encode_image(plate_crop, images_config)
+        thumbnail = get_thumbnail(annotated_frame, images_config.get('thumbnail_width', 640))
+        thumbnail_extension, thumbnail_data = encode_image(thumbnail, images_config)
+        thumbnail_path = os.path.join(image_dir, f"{image_name}_context{thumbnail_extension}")
+        write_file_atomic(thumbnail_path, thumbnail_data)
+        index_image(thumbnail_path, len(thumbnail_data))
+    else:
+        extension, image_data = encode_image(annotated_frame, images_config)
+    image_path = os.path.join(image_dir, f"{image_name}{extension}")
+    write_file_atomic(image_path, image_data)
+    index_image(image_path, len(image_data))
 
-    # with open(image_path, "wb") as file:
-    #     file.write(snapshot)
     _LOGGER.info(f"Saving image with path: {image_path}")
-    return image_path
+    return image_path, image_data
 
 
 def check_invalid_event(before_data, after_data):
@@ -328,77 +1511,280 @@ def check_invalid_event(before_data, after_data):
     return False
 
 
-def get_latest_snapshot(frigate_event_id, frigate_url, camera_name):
-    timestamp = datetime.now()
-    start_time = time.time()
-    print(f"*********{timestamp} Getting snapshot for event: {frigate_event_id}")
-    snapshot_url = f"{frigate_url}/api/{camera_name}/latest.jpg"
-
-    _LOGGER.debug(f"event URL: {snapshot_url}")
-
-    parameters = {"quality": 100}
-    response = requests.get(snapshot_url, params=parameters)
-    snapshot = response.content
-    print(f"*********{timestamp} done snapshot for event: {frigate_event_id}")
-    end_time = time.time()
-    duration = end_time - start_time
-    print(f"*********The process took {duration:.2f} seconds to complete.")
-    return snapshot
-
-def save_snap(snapshot, camera_name):
-    test_image_dir = SNAPSHOT_PATH + "/test"
-    os.makedirs(test_image_dir, exist_ok=True)
-    timestamp = datetime.now().strftime(DATETIME_FORMAT)
-    image_name = f"{camera_name}_{timestamp}_{uuid.uuid4()}.png"
-    image_path = f"{test_image_dir}/{image_name}"
-    with open(image_path, "wb") as file:
-        file.write(snapshot)
-        print(f"{timestamp} saved snapshot {image_path}")
-
-def get_snapshot(frigate_event_id, frigate_url, cropped, camera_name):
-    _LOGGER.debug(f"Getting snapshot for event: {frigate_event_id}, Crop: {cropped}")
-    snapshot_url = f"{frigate_url}/api/events/{frigate_event_id}/snapshot-clean.png"
-    _LOGGER.debug(f"event URL: {snapshot_url}")
-
-    # get snapshot
-    parameters = {"crop": 1 if cropped else 0, "quality": 100}
-    response = requests.get(snapshot_url, params=parameters)
-    snapshot = response.content
-    thread = threading.Thread(
-        target=save_snap,
-        args=(snapshot, camera_name),
-        daemon=True,
+class FrigateClient:
+    def __init__(self, frigate_url, pool_size=10, connect_timeout=3.05, read_timeout=10, retries=2, retry_backoff=0.25):
+        self.frigate_url = frigate_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, path, params=None):
+        url = f"{self.frigate_url}{path}"
+        _LOGGER.debug(f"event URL: {url}")
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.get(url, params=params, timeout=self.timeout)
+                if response.status_code < 500 or attempt == self.retries:
+                    return response
+                _LOGGER.debug(f"Frigate returned {response.status_code} for {url}, retrying")
+            except requests.RequestException as e:
+                if attempt == self.retries:
+                    raise
+                _LOGGER.debug(f"Request to {url} failed: {e}, retrying")
+            # exponential backoff with jitter so workers polling the same camera do not retry in lockstep
+            time.sleep(self.retry_backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+    def get_snapshot(self, frigate_event_id, camera_name, snapshot_config):
+        source = snapshot_config.get('source', 'latest')
+        parameters = {"quality": snapshot_config.get('quality', 100)}
+        if snapshot_config.get('height'):
+            parameters['h'] = snapshot_config['height']
+
+        if source == 'latest':
+            path = f"/api/{camera_name}/latest.jpg"
+        elif source == 'snapshot':
+            path = f"/api/events/{frigate_event_id}/snapshot.jpg"
+            parameters['crop'] = 1 if snapshot_config.get('crop') else 0
+        elif source == 'snapshot_clean':
+            path = f"/api/events/{frigate_event_id}/snapshot-clean.png"
+            parameters = {'crop': 1 if snapshot_config.get('crop') else 0}
+        else:
+            raise ValueError(f"Unknown snapshot source: {source}")
+
+        response = self.get(path, params=parameters)
+        # Check if the request was successful (HTTP status code 200)
+        if response.status_code != 200:
+            _LOGGER.error(f"Error getting snapshot: {response.status_code}")
+            return None
+        return response.content
+
+def get_readability_config(camera_name):
+    readability_config = dict(config['frigate'].get('readability', {}))
+    camera_config = readability_config.pop('cameras', {}).get(camera_name, {})
+    readability_config.update(camera_config)
+    return readability_config
+
+def get_readability(after_data):
+    # decides from the object geometry and motion whether a plate can be read now, later or never for this event
+    readability_config = get_readability_config(after_data['camera'])
+    if not readability_config:
+        return 'now'
+
+    # a car that has been parked since the event started will not show a better plate
+    max_motionless_count = readability_config.get('max_motionless_count')
+    if (max_motionless_count is not None and after_data.get('stationary')
+            and after_data.get('motionless_count', 0) >= max_motionless_count):
+        if after_data.get('position_changes', 0) <= readability_config.get('parked_position_changes', 0):
+            return 'never'
+        return 'later'
+
+    box = after_data.get('box')
+    if box:
+        box_width, box_height = box[2] - box[0], box[3] - box[1]
+        if box_width < readability_config.get('min_box_width', 0) or box_height < readability_config.get('min_box_height', 0):
+            return 'later'
+        detect_resolution = config['frigate'].get('detect_resolution', {}).get(after_data['camera'])
+        if detect_resolution and box_width / detect_resolution[0] < readability_config.get('min_box_fraction', 0):
+            return 'later'
+    if after_data.get('area', float('inf')) < readability_config.get('min_area', 0):
+        return 'later'
+    ratio = after_data.get('ratio')
+    if ratio is not None and not readability_config.get('min_ratio', 0) <= ratio <= readability_config.get('max_ratio', float('inf')):
+        return 'later'
+    return 'now'
+
+def check_readability(after_data):
+    readability = get_readability(after_data)
+    READABILITY_STATS[readability] += 1
+    if readability != 'now':
+        _LOGGER.debug(f"Plate of event {after_data['id']} readable: {readability}")
+    return readability
+
+def get_snapshot_config(camera_name):
+    snapshot_config = dict(config['frigate'].get('snapshot', {}))
+    camera_config = snapshot_config.pop('cameras', {}).get(camera_name, {})
+    snapshot_config.update(camera_config)
+    return snapshot_config
+
+def setup_frigate_client():
+    global frigate_client
+    frigate_config = config['frigate']
+    frigate_client = FrigateClient(
+        frigate_config['frigate_url'],
+        pool_size=frigate_config.get('recognition_workers', 10),
+        connect_timeout=frigate_config.get('connect_timeout', 3.05),
+        read_timeout=frigate_config.get('read_timeout', 10),
+        retries=frigate_config.get('retries', 2),
     )
-    thread.start()
-    # Check if the request was successful (HTTP status code 200)
-    if response.status_code != 200:
-        _LOGGER.error(f"Error getting snapshot: {response.status_code}")
-        return
-
-    return snapshot
 
+class StreamReader:
+    # reads a camera stream or video file on its own thread, frames are only converted when one is asked for
+    def __init__(self, url, idle_timeout=30, reconnect_delay=5):
+        self.url = url
+        self.frame = None
+        self.requested = 0
+        self.retrieved = 0
+        self.condition = threading.Condition()
+        self.idle_timeout = idle_timeout
+        self.reconnect_delay = reconnect_delay
+        self.last_access = time.monotonic()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def get_frame(self, timeout=5):
+        with self.condition:
+            self.last_access = time.monotonic()
+            self.requested += 1
+            request = self.requested
+            self.condition.wait_for(lambda: self.retrieved >= request or self.stopped.is_set(), timeout)
+            return self.frame if self.retrieved >= request else None
+
+    def is_running(self):
+        return not self.stopped.is_set()
+
+    def is_idle(self):
+        return time.monotonic() - self.last_access > self.idle_timeout
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        is_file = os.path.isfile(self.url)
+        while not self.stopped.is_set() and not self.is_idle():
+            capture = cv2.VideoCapture(self.url)
+            frames_read = self.read_frames(capture, is_file)
+            capture.release()
+            # video files start over at the end, streams are reconnected after a delay
+            if not frames_read or not is_file:
+                _LOGGER.warning(f"Stream {self.url} stopped after {frames_read} frames, reconnecting in {self.reconnect_delay}s")
+                self.stopped.wait(self.reconnect_delay)
+        self.stopped.set()
+        with self.condition:
+            self.condition.notify_all()
+        _LOGGER.debug(f"Stopped reading {self.url}")
+
+    def read_frames(self, capture, is_file):
+        # every frame is grabbed to keep the decoder current, but only the frames asked for by get_frame are
+        # converted and copied out. Files are read at their own frame rate, streams as fast as frames arrive
+        fps = capture.get(cv2.CAP_PROP_FPS) if is_file else 0
+        frame_interval = 1 / fps if fps and fps > 0 else 0
+        next_frame_time = time.monotonic()
+        frames_read = 0
+        while not self.stopped.is_set() and not self.is_idle():
+            if not capture.grab():
+                break
+            frames_read += 1
+            with self.condition:
+                requested = self.requested
+            if requested > self.retrieved:
+                success, image = capture.retrieve()
+                if not success:
+                    break
+                with self.condition:
+                    self.frame = image
+                    self.retrieved = requested
+                    self.condition.notify_all()
+            if frame_interval:
+                next_frame_time += frame_interval
+                self.stopped.wait(max(next_frame_time - time.monotonic(), 0))
+        return frames_read
+
+def get_stream_reader(camera_name, snapshot_config):
+    with stream_readers_lock:
+        reader = STREAM_READERS.get(camera_name)
+        if reader is None or not reader.is_running():
+            _LOGGER.info(f"Starting stream reader for camera {camera_name}")
+            reader = StreamReader(snapshot_config['stream_url'], snapshot_config.get('stream_idle_timeout', 30))
+            STREAM_READERS[camera_name] = reader
+        return reader
+
+def prepare_frame_source(camera_name):
+    # the stream is opened when the event starts, so a frame is ready by the first attempt
+    snapshot_config = get_snapshot_config(camera_name)
+    if snapshot_config.get('source') == 'stream':
+        get_stream_reader(camera_name, snapshot_config)
+
+def get_stream_frame(frigate_event_id, camera_name, snapshot_config):
+    with stage('snapshot'):
+        image = get_stream_reader(camera_name, snapshot_config).get_frame(snapshot_config.get('stream_wait', 5))
+    if image is None:
+        _LOGGER.error(f"No frame from stream of camera {camera_name} for event {frigate_event_id}")
+        return None
+    return Frame(image=image)
+
+def get_snapshot(frigate_event_id, camera_name):
+    _LOGGER.debug(f"Getting snapshot for event: {frigate_event_id}")
+    snapshot_config = get_snapshot_config(camera_name)
+    if snapshot_config.get('source') == 'stream':
+        return get_stream_frame(frigate_event_id, camera_name, snapshot_config)
+    try:
+        with stage('snapshot'):
+            return frigate_client.get_snapshot(frigate_event_id, camera_name, snapshot_config)
+    except requests.RequestException as e:
+        _LOGGER.error(f"Error getting snapshot for event {frigate_event_id}: {e}")
+        return None
+
+
+def report_watched_plate(frame, after_data, frigate_url, frigate_event_id, detected_plate_number, detected_plate_score, watched_plate, fuzzy_score):
+    count_event('matched')
+    start_time = datetime.fromtimestamp(after_data['start_time'])
+    formatted_start_time = start_time.strftime("%Y-%m-%d %H:%M:%S")
+    store_plate_in_db(formatted_start_time, detected_plate_number, fuzzy_score, frigate_event_id,after_data['camera'], watched_plate, True)
+    with stage('image_save'):
+        image_path, image_data = save_image(config,detected_plate_score,frame,after_data,frigate_url,frigate_event_id,plate_number=detected_plate_number)
+    with stage('publish'):
+        send_mqtt_message(detected_plate_number, detected_plate_score, frigate_event_id, after_data, watched_plate,config['frigate'].get('watched_plates'),  fuzzy_score,image_data)
+    _LOGGER.info(f"Plate {detected_plate_number} matches watched plate {watched_plate} for event {frigate_event_id}")
+
+def get_db_connection():
+    # one long lived connection per thread, sqlite3 caches the prepared statements on each connection
+    conn = getattr(db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, timeout=DB_TIMEOUT, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        db_local.conn = conn
+    return conn
+
+def mark_event_resolved(frigate_event_id):
+    with resolved_events_lock:
+        RESOLVED_EVENTS[frigate_event_id] = True
+        RESOLVED_EVENTS.move_to_end(frigate_event_id)
+        while len(RESOLVED_EVENTS) > RESOLVED_EVENTS_CACHE_SIZE:
+            RESOLVED_EVENTS.popitem(last=False)
+
+def is_event_resolved(frigate_event_id):
+    with resolved_events_lock:
+        return frigate_event_id in RESOLVED_EVENTS
 
 def is_duplicate_event(frigate_event_id):
      # see if we have already processed this event
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""SELECT * FROM plates WHERE frigate_event_id = ?""", (frigate_event_id,))
+    if is_event_resolved(frigate_event_id):
+        _LOGGER.debug(f"Skipping event: {frigate_event_id} because it has already been processed")
+        return True
+
+    cursor = get_db_connection().execute("""SELECT plate_found FROM plates WHERE frigate_event_id = ?""", (frigate_event_id,))
     row = cursor.fetchone()
-    conn.close()
 
     if row is not None:
+        mark_event_resolved(frigate_event_id)
         _LOGGER.debug(f"Skipping event: {frigate_event_id} because it has already been processed")
         return True
 
     return False
 
-def get_plate(snapshot):
+def get_plate(frame, after_data):
     # try to get plate number
     detected_plate_number = None
     detected_plate_score = None
 
     if config.get('fast_alpr'):
-        detected_plate_number, detected_plate_score = fast_alpr(snapshot)
+        detected_plate_number, detected_plate_score = fast_alpr(frame, after_data)
     else:
         _LOGGER.error("Plate Recognizer is not configured")
         return None, None, None, None
@@ -407,30 +1793,74 @@ def get_plate(snapshot):
 
 
 def is_plate_found_for_event(frigate_event_id):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""SELECT plate_found FROM plates WHERE frigate_event_id = ?""", (frigate_event_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return bool(result[0]) if result else None
+    # every plate is stored by this process, so the in-memory cache is authoritative for live events
+    return is_event_resolved(frigate_event_id)
 
 def store_plate_in_db(detection_time, plate_number, fuzzy_score, frigate_event_id, camera_name, watched_plate, plate_found ):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-
     _LOGGER.info(f"Storing plate number in database: {plate_number} with score: {fuzzy_score}")
 
-    cursor.execute("""INSERT INTO plates (detection_time, fuzzy_score , plate_number, frigate_event_id , camera_name, watched_plate, plate_found  ) VALUES (?, ?, ?, ?, ?, ?, ?)""",
-                   (detection_time, fuzzy_score, plate_number, frigate_event_id, camera_name,watched_plate, plate_found)
-                   )
+    if plate_found:
+        mark_event_resolved(frigate_event_id)
+    db_write_queue.put((
+        """INSERT OR IGNORE INTO plates (detection_time, fuzzy_score , plate_number, frigate_event_id , camera_name, watched_plate, plate_found  ) VALUES (?, ?, ?, ?, ?, ?, ?)""",
+        (detection_time, fuzzy_score, plate_number, frigate_event_id, camera_name,watched_plate, plate_found)
+    ))
+
+def write_db_batch(batch):
+    statements = collections.defaultdict(list)
+    for sql, params in batch:
+        statements[sql].append(params)
+    conn = get_db_connection()
+    try:
+        with stage('db_write'), conn:
+            for sql, params_list in statements.items():
+                conn.executemany(sql, params_list)
+        DB_WRITER_STATS['written'] += len(batch)
+        DB_WRITER_STATS['batches'] += 1
+    except sqlite3.Error as e:
+        DB_WRITER_STATS['failed'] += len(batch)
+        _LOGGER.error(f"Failed to write {len(batch)} rows to database: {e}")
+
+def run_db_writer():
+    batch_size = config.get('db_batch_size', 100)
+    flush_interval = config.get('db_flush_interval', 1.0)
+    stopping = False
+    while not stopping:
+        item = db_write_queue.get()
+        if item is None:
+            break
+        batch = [item]
+        flush_at = time.monotonic() + flush_interval
+        while len(batch) < batch_size:
+            try:
+                item = db_write_queue.get(timeout=max(flush_at - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if item is None:
+                stopping = True
+                break
+            batch.append(item)
+        write_db_batch(batch)
+
+def start_db_writer():
+    global db_writer_thread
+    db_writer_thread = threading.Thread(target=run_db_writer, daemon=True)
+    db_writer_thread.start()
+    atexit.register(stop_db_writer)
+
+def stop_db_writer():
+    # flush everything queued before shutdown
+    if db_writer_thread is None or not db_writer_thread.is_alive():
+        return
+    db_write_queue.put(None)
+    db_writer_thread.join()
 
-    conn.commit()
-    conn.close()
+def get_db_writer_stats():
+    return dict(DB_WRITER_STATS, queue_depth=db_write_queue.qsize())
 
 def setup_db():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
+    conn = get_db_connection()
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS plates (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             detection_time TIMESTAMP NOT NULL,
@@ -444,7 +1874,34 @@ def setup_db():
         )
     """)
     conn.commit()
-    conn.close()
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS images (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            path TEXT NOT NULL UNIQUE,
+            size INTEGER NOT NULL,
+            created REAL NOT NULL
+        )
+    """)
+    conn.execute("""CREATE INDEX IF NOT EXISTS images_created ON images (created)""")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS traces (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            frigate_event_id TEXT NOT NULL,
+            camera TEXT NOT NULL,
+            started REAL NOT NULL,
+            duration REAL NOT NULL,
+            attempts INTEGER NOT NULL,
+            outcome TEXT NOT NULL,
+            spans TEXT NOT NULL
+        )
+    """)
+    conn.execute("""CREATE INDEX IF NOT EXISTS traces_started ON traces (started)""")
+    conn.commit()
+
+    cursor = conn.execute("""SELECT frigate_event_id FROM plates WHERE plate_found ORDER BY id DESC LIMIT ?""", (RESOLVED_EVENTS_CACHE_SIZE,))
+    for (frigate_event_id,) in reversed(cursor.fetchall()):
+        mark_event_resolved(frigate_event_id)
 
 def load_config():
     global config
@@ -454,45 +1911,579 @@ def load_config():
     if SNAPSHOT_PATH and not os.path.isdir(SNAPSHOT_PATH):
         os.makedirs(SNAPSHOT_PATH)
 
-def run_mqtt_client():
-    global mqtt_client
-    _LOGGER.info(f"Starting MQTT client. Connecting to: {config['frigate']['mqtt_server']}")
+    build_watched_plate_matcher()
 
-    # setup mqtt client
-    mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
-    mqtt_client.enable_logger()
-    mqtt_client.on_connect = on_connect
-    mqtt_client.on_disconnect = on_disconnect
-    mqtt_client.on_message = on_message
+def reload_config():
+    global config
+    with open(CONFIG_PATH, 'r') as config_file:
+        new_config = yaml.safe_load(config_file)
+
+    old_fast_alpr = config.get('fast_alpr') or {}
+    new_fast_alpr = new_config.get('fast_alpr') or {}
+    models_changed = get_alpr_model_key(new_fast_alpr) != get_alpr_model_key(old_fast_alpr)
+    inference_changed = models_changed or any(new_fast_alpr.get(key) != old_fast_alpr.get(key) for key in INFERENCE_SETTINGS)
+    process_changed = models_changed or any(new_fast_alpr.get(key) != old_fast_alpr.get(key) for key in PROCESS_SETTINGS)
+    if models_changed and new_config.get('fast_alpr'):
+        _LOGGER.info("fast_alpr models changed, reloading ALPR models")
+        if not is_process_inference(new_config):
+            preload_alpr_models(new_config['fast_alpr'])
+
+    watched_plates_changed = new_config['frigate'].get('watched_plates') != config['frigate'].get('watched_plates')
+    config = new_config
+    if models_changed and config.get('fast_alpr'):
+        unload_stale_alpr_models()
+    if inference_changed and config.get('fast_alpr'):
+        setup_inference(restart_pool=process_changed)
+    if watched_plates_changed:
+        build_watched_plate_matcher()
+    _LOGGER.info("Config reloaded")
+
+def watch_config():
+    global config_mtime
+    interval = config.get('config_reload_interval', 30)
+    config_mtime = os.path.getmtime(CONFIG_PATH)
+    while True:
+        time.sleep(interval)
+        try:
+            mtime = os.path.getmtime(CONFIG_PATH)
+            if mtime != config_mtime:
+                config_mtime = mtime
+                reload_config()
+        except Exception as e:
+            _LOGGER.error(f"Failed to reload config: {e}")
+
+def create_mqtt_client():
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    client.enable_logger()
+    client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
+    client.on_message = on_message
 
 
     if config['frigate'].get('mqtt_username', False):
         username = config['frigate']['mqtt_username']
         password = config['frigate'].get('mqtt_password', '')
-        mqtt_client.username_pw_set(username, password)
+        client.username_pw_set(username, password)
+    return client
+
+def run_mqtt_client():
+    global mqtt_client
+    _LOGGER.info(f"Starting MQTT client. Connecting to: {config['frigate']['mqtt_server']}")
 
+    # setup mqtt client
+    mqtt_client = create_mqtt_client()
     mqtt_client.connect(config['frigate']['mqtt_server'], config['frigate'].get('mqtt_port', 1883))
     mqtt_client.loop_forever()
 
-def delete_old_files():
-
-    folder_path = SNAPSHOT_PATH
-    days=config.get('days_to_keep_images')
+class AsyncioMqttHelper:
+    # drives the paho client from the asyncio event loop instead of its own network thread
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.misc_task = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        self.misc_task = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        if self.misc_task is not None:
+            self.misc_task.cancel()
+
+    def on_socket_register_write(self, client, userdata, sock):
+        # publishes happen on executor threads, so hand the writer registration to the loop
+        self.loop.call_soon_threadsafe(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.remove_writer, sock)
+
+    async def misc_loop(self):
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+async def reconnect_async(client):
+    while True:
+        try:
+            client.reconnect()
+            return
+        except Exception as e:
+            _LOGGER.warning(f"Reconnection failed due to {e}, retrying in 60 seconds")
+            await asyncio.sleep(60)
+
+async def run_event_task(event, io_executor, cpu_executor):
+    loop = asyncio.get_running_loop()
+    max_attempts = config['frigate'].get('max_attempts')
+    attempt_interval = config['frigate'].get('attempt_interval', 0.5)
+    frigate_event_id = event['id']
+    try:
+        while True:
+            event['updated'].clear()
+            after_data = event['after_data']
+            readability = check_readability(after_data)
+            if readability == 'never':
+                event['outcome'] = "plate not readable"
+                _LOGGER.info(f"Done processing event {frigate_event_id} after {event['attempts']} attempts: plate not readable")
+                return
+            if readability == 'later':
+                await event['updated'].wait()
+                continue
+            trace_attempt(frigate_event_id)
+            snapshot = await loop.run_in_executor(io_executor, run_traced, frigate_event_id, get_snapshot, frigate_event_id, after_data['camera'])
+            done = await loop.run_in_executor(cpu_executor, run_traced, frigate_event_id, recognize_snapshot,
+                                              after_data, event['frigate_url'], frigate_event_id, snapshot)
+            event['attempts'] += 1
+            if done:
+                event['outcome'] = "plate resolved"
+                _LOGGER.info(f"Done processing event {frigate_event_id} after {event['attempts']} attempts: plate resolved")
+                return
+            if max_attempts and event['attempts'] >= max_attempts:
+                event['outcome'] = "max attempts reached"
+                _LOGGER.info(f"Done processing event {frigate_event_id} after {event['attempts']} attempts: max attempts reached")
+                return
+            # the next attempt starts on a frigate update or after the attempt interval, whichever comes first
+            try:
+                await asyncio.wait_for(event['updated'].wait(), timeout=attempt_interval or None)
+            except asyncio.TimeoutError:
+                pass
+    except Exception as e:
+        _LOGGER.error(f"Failed to process event {frigate_event_id}: {e}")
+
+async def run_event_with_deadline(event, io_executor, cpu_executor):
+    event_timeout = config['frigate'].get('event_timeout', 300)
+    try:
+        await asyncio.wait_for(run_event_task(event, io_executor, cpu_executor), timeout=event_timeout or None)
+    except asyncio.TimeoutError:
+        event['outcome'] = "deadline reached"
+        _LOGGER.info(f"Done processing event {event['id']} after {event['attempts']} attempts: deadline reached")
+    finally:
+        ASYNC_EVENTS.pop(event['id'], None)
+        if event.get('outcome') in ("max attempts reached", "deadline reached"):
+            remember_unresolved_event(event['id'])
+        forget_event_state(event['id'])
+        finish_trace(event['id'], event['attempts'], event.get('outcome', "ended"))
+
+async def dispatch_async_message(message, io_executor, cpu_executor):
+    parsed_message = parse_event_message(message, check_duplicate=False)
+    if parsed_message is None:
+        return
+    event_type, after_data = parsed_message
+    frigate_event_id = after_data["id"]
+    event = ASYNC_EVENTS.get(frigate_event_id)
+    # the database lookup runs on the I/O threads, so the event loop is not blocked by sqlite
+    if event_type == "new" and event is None and \
+            await asyncio.get_running_loop().run_in_executor(io_executor, is_duplicate_event, frigate_event_id):
+        count_event('deduped')
+        return
 
-    now = time.time()
-    cutoff = now - (days * 86400)  # 86400 seconds in a day
+    if event_type == "end":
+        if event is not None:
+            event['task'].cancel()
+            remember_unresolved_event(frigate_event_id)
+            _LOGGER.info(f"Event {frigate_event_id} ended after {event['attempts']} attempts")
+        request_clip_scan(after_data)
+    elif event_type == "update":
+        if event is not None:
+            event['after_data'] = after_data
+            event['updated'].set()
+    elif event_type == "new" and event is None:
+        _LOGGER.info(f"Scheduling new event {frigate_event_id}")
+        event = {
+            'id': frigate_event_id,
+            'after_data': after_data,
+            'frigate_url': config["frigate"]["frigate_url"],
+            'attempts': 0,
+            'updated': asyncio.Event(),
+        }
+        ASYNC_EVENTS[frigate_event_id] = event
+        start_trace(frigate_event_id, after_data['camera'])
+        prepare_frame_source(after_data['camera'])
+        event['task'] = asyncio.get_running_loop().create_task(run_event_with_deadline(event, io_executor, cpu_executor))
+
+def enqueue_async_message(message_queue, message):
+    try:
+        message_queue.put_nowait(message)
+    except asyncio.QueueFull:
+        if get_payload_event_type(message.payload) == b'end':
+            # a missed end would leave its event running, so it waits for room instead of being dropped. The
+            # event loop only keeps weak references to tasks, so the pending put is kept until it is done
+            task = asyncio.get_running_loop().create_task(message_queue.put(message))
+            pending_end_messages.add(task)
+            task.add_done_callback(pending_end_messages.discard)
+            return
+        INGEST_STATS['dropped'] += 1
+        _LOGGER.debug("MQTT message queue full, dropping message")
+
+async def run_async_runtime():
+    global mqtt_client
+    loop = asyncio.get_running_loop()
+    message_queue = asyncio.Queue(maxsize=config['frigate'].get('max_queued_messages', 1000))
+    io_executor = ThreadPoolExecutor(max_workers=config['frigate'].get('io_workers', 4))
+    cpu_executor = ThreadPoolExecutor(max_workers=config['frigate'].get('recognition_workers', 10))
+
+    _LOGGER.info(f"Starting asyncio MQTT client. Connecting to: {config['frigate']['mqtt_server']}")
+    mqtt_client = create_mqtt_client()
+    def on_async_message(client, userdata, message):
+        if is_homeassistant_status(message):
+            on_homeassistant_status(client, message)
+            return
+        if not is_relevant_payload(message.payload):
+            INGEST_STATS['filtered'] += 1
+            return
+        enqueue_async_message(message_queue, message)
+
+    # paho callbacks run on the event loop thread, so messages go straight into the queue
+    mqtt_client.on_message = on_async_message
+    mqtt_client.on_disconnect = lambda client, userdata, flags, reason_code, properties: (
+        loop.create_task(reconnect_async(client)) if reason_code != 0 else _LOGGER.error("Expected disconnection"))
+    AsyncioMqttHelper(loop, mqtt_client)
+    mqtt_client.connect(config['frigate']['mqtt_server'], config['frigate'].get('mqtt_port', 1883))
 
-    for filename in os.listdir(folder_path):
-        file_path = os.path.join(folder_path, filename)
+    while True:
+        message = await message_queue.get()
+        try:
+            await dispatch_async_message(message, io_executor, cpu_executor)
+        except Exception as e:
+            _LOGGER.error(f"Failed to process MQTT message: {e}")
+
+def index_image(image_path, size, created=None):
+    db_write_queue.put((
+        """INSERT OR REPLACE INTO images (path, size, created) VALUES (?, ?, ?)""",
+        (image_path, size, time.time() if created is None else created)
+    ))
+
+def index_existing_images():
+    # images saved before the index existed are added once, after that the snapshot folder is never listed
+    conn = get_db_connection()
+    if conn.execute("""SELECT 1 FROM images LIMIT 1""").fetchone() is not None or not os.path.isdir(SNAPSHOT_PATH):
+        return
+    rows = []
+    for root, _, filenames in os.walk(SNAPSHOT_PATH):
+        for filename in filenames:
+            stat = os.stat(os.path.join(root, filename))
+            rows.append((os.path.join(root, filename), stat.st_size, stat.st_mtime))
+    with conn:
+        conn.executemany("""INSERT OR IGNORE INTO images (path, size, created) VALUES (?, ?, ?)""", rows)
+    _LOGGER.info(f"Indexed {len(rows)} existing images")
+
+def delete_images(rows):
+    # only rows whose file is gone leave the index, the others are tried again on the next run
+    conn = get_db_connection()
+    deleted = []
+    for row in rows:
+        _, image_path, size = row
+        try:
+            os.remove(image_path)
+            RETENTION_STATS['deleted_bytes'] += size
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            RETENTION_STATS['failed'] += 1
+            _LOGGER.error(f"Failed to delete {image_path}: {e}")
+            continue
+        deleted.append(row)
+        remove_empty_image_dirs(os.path.dirname(image_path))
+    with conn:
+        conn.executemany("""DELETE FROM images WHERE id = ?""", [(image_id,) for image_id, _, _ in deleted])
+    RETENTION_STATS['deleted'] += len(deleted)
+    return deleted
+
+def remove_empty_image_dirs(image_dir):
+    # date and camera folders are removed once their last image is gone
+    snapshot_path = os.path.abspath(SNAPSHOT_PATH)
+    image_dir = os.path.abspath(image_dir)
+    while image_dir.startswith(snapshot_path + os.sep):
+        try:
+            os.rmdir(image_dir)
+        except OSError:
+            return
+        image_dir = os.path.dirname(image_dir)
+
+def delete_old_images():
+    days = config.get('days_to_keep_images')
+    max_bytes = config.get('max_image_bytes')
+    batch_size = config.get('retention_batch_size', 500)
+    conn = get_db_connection()
+
+    if days:
+        cutoff = time.time() - days * 86400
+        while True:
+            rows = conn.execute("""SELECT id, path, size FROM images WHERE created < ? ORDER BY created LIMIT ?""",
+                                (cutoff, batch_size)).fetchall()
+            deleted = delete_images(rows)
+            if len(rows) < batch_size or not deleted:
+                break
 
-        if os.path.isfile(file_path):
-            file_mtime = os.path.getmtime(file_path)
-            if file_mtime < cutoff:
-                try:
-                    os.remove(file_path)
-                    print(f"Deleted: {file_path}")
-                except Exception as e:
-                    print(f"Failed to delete {file_path}: {e}")
+    if max_bytes:
+        total_bytes = conn.execute("""SELECT COALESCE(SUM(size), 0) FROM images""").fetchone()[0]
+        while total_bytes > max_bytes:
+            rows = conn.execute("""SELECT id, path, size FROM images ORDER BY created LIMIT ?""", (batch_size,)).fetchall()
+            if not rows:
+                break
+            # oldest images first, only as many as are needed to get under the quota
+            batch = []
+            batch_bytes = 0
+            for row in rows:
+                if total_bytes - batch_bytes <= max_bytes:
+                    break
+                batch.append(row)
+                batch_bytes += row[2]
+            deleted = delete_images(batch)
+            if not deleted:
+                break
+            total_bytes -= sum(size for _, _, size in deleted)
+
+def watch_retention():
+    interval = config.get('retention_interval', 3600)
+    index_existing_images()
+    while True:
+        try:
+            delete_old_images()
+        except Exception as e:
+            _LOGGER.error(f"Failed to delete old images: {e}")
+        time.sleep(interval)
+
+def get_retention_stats():
+    return dict(RETENTION_STATS)
+
+def remember_unresolved_event(frigate_event_id):
+    # events that stopped without a plate, their clip is scanned once frigate ends the event
+    if not config['frigate'].get('clip_scan') or is_event_resolved(frigate_event_id):
+        return
+    with unresolved_events_lock:
+        UNRESOLVED_EVENTS[frigate_event_id] = True
+        while len(UNRESOLVED_EVENTS) > RESOLVED_EVENTS_CACHE_SIZE:
+            UNRESOLVED_EVENTS.popitem(last=False)
+
+def request_clip_scan(after_data):
+    with unresolved_events_lock:
+        unresolved = UNRESOLVED_EVENTS.pop(after_data['id'], None)
+    if not unresolved or clip_scan_queue is None or is_event_resolved(after_data['id']):
+        return
+    if not after_data.get('has_clip', True):
+        _LOGGER.debug(f"No clip to scan for event {after_data['id']}")
+        return
+    try:
+        clip_scan_queue.put_nowait(after_data)
+        CLIP_SCAN_STATS['queued'] += 1
+    except queue.Full:
+        CLIP_SCAN_STATS['dropped'] += 1
+        _LOGGER.debug(f"Clip scan queue full, dropping event {after_data['id']}")
+
+def get_clip_scan_config():
+    clip_config = config['frigate'].get('clip_scan')
+    return clip_config if isinstance(clip_config, dict) else {}
+
+def get_event_clip(after_data, clip_config):
+    # returns the clip path and whether it is a downloaded copy that has to be removed
+    clips_path = clip_config.get('clips_path')
+    if clips_path:
+        clip_path = os.path.join(clips_path, f"{after_data['camera']}-{after_data['id']}.mp4")
+        if os.path.isfile(clip_path):
+            return clip_path, False
+    response = frigate_client.get(f"/api/events/{after_data['id']}/clip.mp4")
+    if response.status_code != 200:
+        _LOGGER.error(f"Error getting clip for event {after_data['id']}: {response.status_code}")
+        return None, False
+    with tempfile.NamedTemporaryFile(suffix='.mp4', delete=False) as clip_file:
+        clip_file.write(response.content)
+    return clip_file.name, True
+
+def get_sharpness(image):
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    if gray.shape[1] > 640:
+        gray = cv2.resize(gray, (640, int(gray.shape[0] * 640 / gray.shape[1])), interpolation=cv2.INTER_AREA)
+    return cv2.Laplacian(gray, cv2.CV_64F).var()
+
+def sample_clip_frames(clip_path, clip_config):
+    # frames are sampled while the object was tracked, between the pre and post capture, and the sharpest are kept
+    capture = cv2.VideoCapture(clip_path)
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS) or 25
+        duration = capture.get(cv2.CAP_PROP_FRAME_COUNT) / fps
+        start = min(clip_config.get('pre_capture', 5), duration)
+        end = max(duration - clip_config.get('post_capture', 5), start)
+        interval = clip_config.get('sample_interval', 0.5)
+        candidates = []
+        position = start
+        while position <= end:
+            capture.set(cv2.CAP_PROP_POS_MSEC, position * 1000)
+            success, image = capture.read()
+            if not success:
+                break
+            candidates.append((get_sharpness(image), image))
+            position += interval
+    finally:
+        capture.release()
+    candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+    return [image for _, image in candidates[:clip_config.get('frames', 8)]]
+
+def scan_event_clip(after_data):
+    frigate_event_id = after_data['id']
+    clip_config = get_clip_scan_config()
+    clip_path, downloaded = get_event_clip(after_data, clip_config)
+    if clip_path is None:
+        return False
+    try:
+        images = sample_clip_frames(clip_path, clip_config)
+    finally:
+        if downloaded:
+            os.remove(clip_path)
+    if not images:
+        return False
+
+    # process mode has no models loaded in this process, so frames go to the workers one by one
+    results = predict_batch(images) if process_pool is None else [run_alpr(image) for image in images]
+    consensus = None
+    best_frame = None
+    best_score = 0
+    try:
+        for image, image_results in zip(images, results):
+            for result in image_results:
+                if result.ocr is None or not result.ocr.text:
+                    continue
+                consensus = add_plate_read(frigate_event_id, result.ocr.text, result.ocr.confidence)
+                score = statistics.mean(result.ocr.confidence) if isinstance(result.ocr.confidence, list) else result.ocr.confidence
+                if best_frame is None or score > best_score:
+                    best_frame, best_score = Frame(image=image), score
+                    best_frame.results = image_results
+    finally:
+        forget_event_state(frigate_event_id)
+    CLIP_SCAN_STATS['scanned'] += 1
+    if consensus is None:
+        _LOGGER.debug(f"No plate found in clip of event {frigate_event_id}")
+        return False
+
+    with stage('fuzzy_match'):
+        watched_plate, fuzzy_score = check_watched_plates(consensus['plate'])
+    _LOGGER.info(f"Clip scan of event {frigate_event_id} read plate {consensus['plate']} from {consensus['votes']} frames")
+    if watched_plate is None or fuzzy_score is None:
+        return False
+    CLIP_SCAN_STATS['found'] += 1
+    report_watched_plate(best_frame, after_data, config['frigate']['frigate_url'], frigate_event_id, consensus['plate'],
+                         consensus['score'], watched_plate, fuzzy_score)
+    return True
+
+def run_clip_scanner():
+    # clip scans are background work, so the thread gives up the CPU to live recognition
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 10)
+    except (AttributeError, OSError) as e:
+        _LOGGER.debug(f"Could not lower clip scan priority: {e}")
+    while True:
+        after_data = clip_scan_queue.get()
+        try:
+            scan_event_clip(after_data)
+        except Exception as e:
+            CLIP_SCAN_STATS['failed'] += 1
+            _LOGGER.error(f"Failed to scan clip of event {after_data['id']}: {e}")
+
+def start_clip_scanner():
+    global clip_scan_queue
+    clip_scan_queue = queue.Queue(maxsize=get_clip_scan_config().get('max_queued', 20))
+    threading.Thread(target=run_clip_scanner, daemon=True).start()
+
+def render_metrics():
+    lines = [
+        "# HELP plate_recognizer_stage_duration_seconds Time spent in each pipeline stage.",
+        "# TYPE plate_recognizer_stage_duration_seconds histogram",
+    ]
+    for stage, histogram in STAGE_DURATIONS.items():
+        counts, total = histogram.snapshot()
+        for bucket, count in zip(histogram.buckets + ('+Inf',), counts):
+            lines.append(f'plate_recognizer_stage_duration_seconds_bucket{{stage="{stage}",le="{bucket}"}} {count}')
+        lines.append(f'plate_recognizer_stage_duration_seconds_sum{{stage="{stage}"}} {total}')
+        lines.append(f'plate_recognizer_stage_duration_seconds_count{{stage="{stage}"}} {counts[-1]}')
+
+    counters = [
+        ('events_total', "Frigate event messages by outcome.", 'result', get_event_counters()),
+        ('frames_total', "Snapshots by frame dedup outcome.", 'result', FRAME_DEDUP_STATS),
+        ('dropped_total', "Work dropped because a queue was full.", 'queue',
+         {'recognition': SCHEDULER_STATS['dropped'], 'ingest': INGEST_STATS['dropped']}),
+        ('prefiltered_total', "MQTT messages skipped before decoding.", 'stage', {'ingest': INGEST_STATS['filtered']}),
+        ('readability_total', "Recognition attempts by readability decision.", 'decision', READABILITY_STATS),
+        ('clip_scans_total', "Post event clip scans by outcome.", 'result', CLIP_SCAN_STATS),
+    ]
+    for name, help_text, label, values in counters:
+        lines.append(f"# HELP plate_recognizer_{name} {help_text}")
+        lines.append(f"# TYPE plate_recognizer_{name} counter")
+        lines.extend(f'plate_recognizer_{name}{{{label}="{key}"}} {value}' for key, value in values.items())
+
+    with events_lock:
+        active_events = len(CURRENT_EVENTS) + len(ASYNC_EVENTS)
+        recognition_queue_depth = len(work_queue)
+    gauges = [
+        ('active_events', "Frigate events being processed.", active_events),
+        ('recognition_queue_depth', "Recognition attempts waiting for a worker.", recognition_queue_depth),
+        ('executor_queue_depth', "Tasks waiting for the shared executor.", executor._work_queue.qsize() if executor else 0),
+        ('db_write_queue_depth', "Rows waiting for the database writer.", db_write_queue.qsize()),
+        ('ingest_queue_depth', "MQTT messages waiting to be processed.", ingest_queue.qsize() if ingest_queue is not None else 0),
+    ]
+    for name, help_text, value in gauges:
+        lines.append(f"# HELP plate_recognizer_{name} {help_text}")
+        lines.append(f"# TYPE plate_recognizer_{name} gauge")
+        lines.append(f"plate_recognizer_{name} {value}")
+    return "\n".join(lines) + "\n"
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = render_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        _LOGGER.debug(f"Metrics request: {format % args}")
+
+def start_metrics_server():
+    global metrics_server
+    metrics_server = ThreadingHTTPServer((config.get('metrics_host', '0.0.0.0'), config['metrics_port']), MetricsHandler)
+    metrics_server.daemon_threads = True
+    threading.Thread(target=metrics_server.serve_forever, daemon=True).start()
+    _LOGGER.info(f"Serving metrics on port {metrics_server.server_port}")
+
+def get_slowest_traces(hours, limit):
+    cursor = get_db_connection().execute(
+        """SELECT frigate_event_id, camera, started, duration, attempts, outcome, spans FROM traces WHERE started >= ? ORDER BY duration DESC LIMIT ?""",
+        (time.time() - hours * 3600, limit))
+    return [{'frigate_event_id': frigate_event_id, 'camera': camera, 'started': started, 'duration': duration,
+             'attempts': attempts, 'outcome': outcome, 'spans': json.loads(spans)}
+            for frigate_event_id, camera, started, duration, attempts, outcome, spans in cursor]
+
+def get_stage_breakdown(spans):
+    breakdown = collections.defaultdict(float)
+    for name, _, _, duration in spans:
+        breakdown[name] += duration
+    return dict(breakdown)
+
+def print_traces(argv):
+    parser = argparse.ArgumentParser(prog='index.py traces', description="print the slowest traced events")
+    parser.add_argument('--hours', type=float, default=24, help="time window in hours")
+    parser.add_argument('--limit', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    traces = get_slowest_traces(args.hours, args.limit)
+    if not traces:
+        print(f"No traced events in the last {args.hours:g} hours")
+        return
+    for trace in traces:
+        started = datetime.fromtimestamp(trace['started']).strftime('%Y-%m-%d %H:%M:%S')
+        print(f"{trace['frigate_event_id']} {trace['camera']} {started} {trace['duration'] * 1000:.0f}ms "
+              f"{trace['attempts']} attempts: {trace['outcome']}")
+        first_fetch = next((offset for name, _, offset, _ in trace['spans'] if name == 'snapshot'), None)
+        if first_fetch is not None:
+            print(f"    first fetch after {first_fetch:.0f}ms")
+        for name, duration in sorted(get_stage_breakdown(trace['spans']).items(), key=lambda item: -item[1]):
+            print(f"    {name:<12} {duration:8.1f}ms")
 
 def load_logger():
     global _LOGGER
@@ -516,11 +2507,18 @@ def load_logger():
     _LOGGER.addHandler(file_handler)
 
 def main():
-    global executor
+    global executor, delayed_actions
+    if sys.argv[1:2] == ['traces']:
+        setup_db()
+        print_traces(sys.argv[2:])
+        return
 
     load_config()
     setup_db()
     load_logger()
+    setup_frigate_client()
+    start_db_writer()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
     current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
     _LOGGER.info(f"Time: {current_time}")
@@ -528,8 +2526,27 @@ def main():
     _LOGGER.info(f"Frigate Plate Recognizer Version: {VERSION}")
     _LOGGER.debug(f"config: {config}")
 
+    if config.get('fast_alpr'):
+        if not is_process_inference(config):
+            get_alpr()
+        setup_inference()
+    if config.get('config_reload_interval', 30):
+        threading.Thread(target=watch_config, daemon=True).start()
+    if config.get('days_to_keep_images') or config.get('max_image_bytes'):
+        threading.Thread(target=watch_retention, daemon=True).start()
+    if config.get('metrics_port'):
+        start_metrics_server()
+    if config.get('fast_alpr') and config['frigate'].get('clip_scan'):
+        start_clip_scanner()
+
     executor = concurrent.futures.ThreadPoolExecutor(max_workers=10)
-    run_mqtt_client()
+    delayed_actions = DelayedActions()
+    if config.get('runtime', 'thread') == 'asyncio':
+        asyncio.run(run_async_runtime())
+    else:
+        start_event_scheduler()
+        start_ingest()
+        run_mqtt_client()
 
 
 if __name__ == '__main__':
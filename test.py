@@ -1,14 +1,26 @@
 
+import asyncio
+import concurrent.futures
+import copy
 import json
 import logging
 from pathlib import Path
 import os
+import queue
+import tempfile
+import threading
+import time
 import unittest
-from unittest.mock import patch, MagicMock, mock_open
+from unittest.mock import patch, MagicMock, mock_open, ANY
 
+import cv2
+import numpy as np
+from fast_alpr.alpr import ALPRResult
+from fast_alpr.base import BoundingBox, DetectionResult, OcrResult
 from PIL import Image, ImageDraw
 import yaml
 
+import benchmark
 import index
 
 class BaseTestCase(unittest.TestCase):
@@ -539,5 +551,1658 @@ class TestStorePlateInDb(BaseTestCase):
         mock_conn.commit.assert_called_once()
         mock_conn.close.assert_called_once()
 
+class TestGetAlpr(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        index.ALPR_MODELS.clear()
+        index.ALPR_MODEL_STATS.clear()
+        index.config = {'fast_alpr': {'plate_detector_model': 'detector', 'ocr_model': 'ocr'}}
+
+    @patch('index.ALPR')
+    def test_models_are_loaded_once(self, mock_alpr):
+        first = index.get_alpr()
+        second = index.get_alpr()
+
+        self.assertIs(first, second)
+        mock_alpr.assert_called_once_with(detector_model='detector', ocr_model='ocr', ocr_device="cpu",
+                                          ocr_model_path=index.CONFIG_PATH + "/models")
+        self.assertIn('detector/ocr', index.get_alpr_model_stats())
+
+    @patch('index.ALPR')
+    def test_reload_swaps_models(self, mock_alpr):
+        mock_alpr.side_effect = [MagicMock(), MagicMock()]
+        old_alpr = index.get_alpr()
+
+        new_config = {'plate_detector_model': 'detector', 'ocr_model': 'new_ocr'}
+        index.preload_alpr_models(new_config)
+        self.assertIs(index.get_alpr(), old_alpr)
+        index.config = {'fast_alpr': new_config}
+        index.unload_stale_alpr_models()
+
+        self.assertIsNot(index.get_alpr(), old_alpr)
+        self.assertEqual(list(index.ALPR_MODELS), [('detector', 'new_ocr')])
+        self.assertEqual(list(index.get_alpr_model_stats()), ['detector/new_ocr'])
+
+    @patch('index.ALPR')
+    def test_reload_config_keeps_old_models_until_config_is_swapped(self, mock_alpr):
+        mock_alpr.side_effect = [MagicMock(), MagicMock()]
+        index.config = {'frigate': {}, 'fast_alpr': {'plate_detector_model': 'detector', 'ocr_model': 'ocr'}}
+        old_alpr = index.get_alpr()
+        new_config = {'frigate': {}, 'fast_alpr': {'plate_detector_model': 'detector', 'ocr_model': 'new_ocr'}}
+        def load_alpr(fast_alpr_config):
+            # recognition running while the new models load still gets the old ones
+            self.assertIs(index.get_alpr(), old_alpr)
+            return mock_alpr()
+
+        with patch('builtins.open', mock_open(read_data=yaml.dump(new_config))), \
+                patch('index.load_alpr', side_effect=load_alpr), patch('index.setup_inference'):
+            index.reload_config()
+
+        self.assertEqual(list(index.ALPR_MODELS), [('detector', 'new_ocr')])
+        self.assertEqual(mock_alpr.call_count, 2)
+
+class TestEventScheduler(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        index.CURRENT_EVENTS.clear()
+        index.work_queue.clear()
+        index.config = {'frigate': {'max_queued_events': 2, 'max_attempts': 2, 'attempt_interval': 0}}
+
+    def start_event(self, frigate_event_id):
+        index.start_event({'id': frigate_event_id, 'camera': 'camera1'}, 'http://example.com', frigate_event_id)
+
+    def test_events_have_a_default_deadline(self):
+        self.start_event('event1')
+        self.assertIsNotNone(index.CURRENT_EVENTS['event1']['deadline'])
+
+        index.config['frigate']['event_timeout'] = 0
+        self.start_event('event2')
+        self.assertIsNone(index.CURRENT_EVENTS['event2']['deadline'])
+
+    def test_one_attempt_in_flight_per_event(self):
+        self.start_event('event1')
+        with index.events_lock:
+            index.schedule_due_events()
+        index.update_event('event1', {'id': 'event1', 'camera': 'camera1'})
+        with index.events_lock:
+            index.schedule_due_events()
+
+        self.assertEqual(len(index.work_queue), 1)
+        self.assertTrue(index.CURRENT_EVENTS['event1']['in_flight'])
+
+    def test_update_triggers_next_attempt(self):
+        self.start_event('event1')
+        with index.events_lock:
+            index.schedule_due_events()
+        event = index.work_queue.popleft()
+        index.complete_attempt(event, False)
+        with index.events_lock:
+            index.schedule_due_events()
+        self.assertEqual(len(index.work_queue), 0)
+
+        index.update_event('event1', {'id': 'event1', 'camera': 'camera1', 'box': [0, 0, 10, 10]})
+        with index.events_lock:
+            index.schedule_due_events()
+        self.assertEqual(list(index.work_queue), [event])
+        self.assertEqual(event['after_data']['box'], [0, 0, 10, 10])
+
+    def test_queue_drops_oldest(self):
+        for frigate_event_id in ['event1', 'event2', 'event3']:
+            self.start_event(frigate_event_id)
+        with index.events_lock:
+            index.schedule_due_events()
+
+        self.assertEqual([event['id'] for event in index.work_queue], ['event2', 'event3'])
+        self.assertFalse(index.CURRENT_EVENTS['event1']['in_flight'])
+
+    def test_end_cancels_event(self):
+        self.start_event('event1')
+        with index.events_lock:
+            index.schedule_due_events()
+        index.cancel_event('event1')
+
+        self.assertNotIn('event1', index.CURRENT_EVENTS)
+        self.assertEqual(len(index.work_queue), 0)
+
+    def test_max_attempts_finishes_event(self):
+        self.start_event('event1')
+        for _ in range(2):
+            with index.events_lock:
+                index.schedule_due_events()
+            index.complete_attempt(index.work_queue.popleft(), False)
+            index.update_event('event1', {'id': 'event1', 'camera': 'camera1'})
+        with index.events_lock:
+            index.schedule_due_events()
+
+        self.assertNotIn('event1', index.CURRENT_EVENTS)
+        self.assertEqual(len(index.work_queue), 0)
+
+class TestPlateStorage(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = patch.object(index, 'DB_PATH', os.path.join(self.tmp_dir.name, 'plates.db'))
+        self.db_path.start()
+        index.db_local = threading.local()
+        index.RESOLVED_EVENTS.clear()
+        index.DB_WRITER_STATS.update(written=0, batches=0, failed=0)
+        index.setup_db()
+        self.db_write_queue = patch('index.db_write_queue', queue.Queue())
+        self.db_write_queue.start()
+
+    def tearDown(self):
+        self.db_write_queue.stop()
+        index.db_local.conn.close()
+        index.db_local = threading.local()
+        self.db_path.stop()
+        self.tmp_dir.cleanup()
+
+    def test_wal_journal_mode(self):
+        journal_mode = index.get_db_connection().execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(journal_mode, 'wal')
+
+    def test_stored_plate_is_found_without_db(self):
+        index.store_plate_in_db('2021-01-01 12:00:00', 'ABC123', 0.9, 'event1', 'camera1', 'ABC123', True)
+
+        with patch('index.get_db_connection') as mock_get_db_connection:
+            self.assertTrue(index.is_plate_found_for_event('event1'))
+            self.assertFalse(index.is_plate_found_for_event('event2'))
+            mock_get_db_connection.assert_not_called()
+
+    def test_resolved_events_loaded_on_startup(self):
+        index.store_plate_in_db('2021-01-01 12:00:00', 'ABC123', 0.9, 'event1', 'camera1', 'ABC123', True)
+        index.write_db_batch([index.db_write_queue.get_nowait()])
+        index.RESOLVED_EVENTS.clear()
+
+        index.setup_db()
+
+        self.assertTrue(index.is_duplicate_event('event1'))
+        self.assertFalse(index.is_duplicate_event('event2'))
+
+    def test_db_writer_batches_and_flushes_on_stop(self):
+        index.config = {'db_batch_size': 10, 'db_flush_interval': 60}
+        for i in range(3):
+            index.store_plate_in_db('2021-01-01 12:00:00', f'ABC12{i}', 0.9, f'event{i}', 'camera1', 'ABC123', True)
+        self.assertEqual(index.get_db_writer_stats()['queue_depth'], 3)
+
+        with patch('index.atexit.register'):
+            index.start_db_writer()
+        index.stop_db_writer()
+
+        rows = index.get_db_connection().execute("SELECT plate_number FROM plates ORDER BY id").fetchall()
+        self.assertEqual(rows, [('ABC120',), ('ABC121',), ('ABC122',)])
+        stats = index.get_db_writer_stats()
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertEqual(stats['batches'], 1)
+
+    def test_resolved_events_cache_is_bounded(self):
+        with patch('index.RESOLVED_EVENTS_CACHE_SIZE', 2):
+            for frigate_event_id in ['event1', 'event2', 'event3']:
+                index.mark_event_resolved(frigate_event_id)
+
+        self.assertEqual(list(index.RESOLVED_EVENTS), ['event2', 'event3'])
+
+def make_jpeg(width=64, height=48):
+    return cv2.imencode('.jpg', np.full((height, width, 3), 128, np.uint8))[1].tobytes()
+
+def make_alpr_result(text='ABC123', confidence=0.9, box=(10, 10, 40, 20)):
+    return ALPRResult(
+        detection=DetectionResult(label='License Plate', confidence=0.8, bounding_box=BoundingBox(*box)),
+        ocr=OcrResult(text=text, confidence=confidence),
+    )
+
+class TestFrame(BaseTestCase):
+    def test_decodes_lazily_once(self):
+        frame = index.Frame(make_jpeg())
+        with patch('index.cv2.imdecode', wraps=cv2.imdecode) as mock_imdecode:
+            self.assertEqual(frame.image.shape, (48, 64, 3))
+            frame.image
+            mock_imdecode.assert_called_once()
+
+    def test_encodes_once_per_format(self):
+        frame = index.Frame(make_jpeg())
+        with patch('index.cv2.imencode', wraps=cv2.imencode) as mock_imencode:
+            self.assertIs(frame.encode('.png'), frame.encode('.png'))
+            mock_imencode.assert_called_once()
+
+class TestSaveAnnotatedImage(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.snapshot_path = patch('index.SNAPSHOT_PATH', self.tmp_dir.name)
+        self.snapshot_path.start()
+        self.db_write_queue = patch('index.db_write_queue', queue.Queue())
+        self.db_write_queue.start()
+
+    def tearDown(self):
+        self.db_write_queue.stop()
+        self.snapshot_path.stop()
+        self.tmp_dir.cleanup()
+
+    @patch('index.get_alpr')
+    def test_reuses_predictions(self, mock_get_alpr):
+        frame = index.Frame(make_jpeg())
+        frame.results = [make_alpr_result()]
+
+        image_path, image_data = index.save_image({}, 0.9, frame, {'camera': 'camera1'}, 'http://example.com', 'event1', 'ABC123')
+
+        mock_get_alpr.assert_not_called()
+        with open(image_path, 'rb') as image_file:
+            self.assertEqual(image_file.read(), image_data)
+        self.assertTrue(image_data.startswith(b'\x89PNG'))
+        # the original frame is left untouched by the annotation
+        self.assertTrue((frame.image == 128).all())
+
+    def test_partitioned_by_date_and_camera(self):
+        image_path, _ = index.save_image({}, 0.9, index.Frame(make_jpeg()), {'camera': 'camera1'}, 'http://example.com', 'event1', 'ABC123')
+
+        date = index.datetime.now().strftime('%Y-%m-%d')
+        self.assertEqual(os.path.dirname(image_path), os.path.join(self.tmp_dir.name, date, 'camera1'))
+        self.assertEqual(os.listdir(os.path.dirname(image_path)), [os.path.basename(image_path)])
+
+    def test_flat_layout(self):
+        image_path, _ = index.save_image({'images': {'partition': False}}, 0.9, index.Frame(make_jpeg()), {'camera': 'camera1'}, 'http://example.com', 'event1', 'ABC123')
+        self.assertEqual(os.path.dirname(image_path), self.tmp_dir.name)
+
+    def test_jpeg_encoding(self):
+        frame = index.Frame(make_jpeg(640, 480))
+        image_path, image_data = index.save_image({'images': {'format': 'jpg', 'quality': 50}}, 0.9, frame, {'camera': 'camera1'}, 'http://example.com', 'event1', 'ABC123')
+
+        self.assertTrue(image_path.endswith('.jpg'))
+        self.assertTrue(image_data.startswith(b'\xff\xd8'))
+
+    def test_unsupported_format(self):
+        with self.assertRaises(ValueError):
+            index.save_image({'images': {'format': 'gif'}}, 0.9, index.Frame(make_jpeg()), {'camera': 'camera1'}, 'http://example.com', 'event1', 'ABC123')
+
+    def test_plate_crop_with_thumbnail(self):
+        frame = index.Frame(make_jpeg(1920, 1080))
+        frame.results = [make_alpr_result('ABC123', 0.9, (100, 200, 300, 260))]
+        images_config = {'images': {'format': 'jpg', 'plate_crop': True, 'thumbnail_width': 320}}
+
+        image_path, image_data = index.save_image(images_config, 0.9, frame, {'camera': 'camera1'}, 'http://example.com', 'event1', 'ABC123')
+
+        plate_image = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_COLOR)
+        self.assertEqual(plate_image.shape[:2], (72, 240))
+        thumbnail_path = image_path.replace('.jpg', '_context.jpg')
+        self.assertEqual(cv2.imread(thumbnail_path).shape[:2], (180, 320))
+        self.assertEqual(index.db_write_queue.qsize(), 2)
+
+    def test_saved_image_is_indexed(self):
+        image_path, image_data = index.save_image({}, 0.9, index.Frame(make_jpeg()), {'camera': 'camera1'}, 'http://example.com', 'event1', 'ABC123')
+
+        sql, params = index.db_write_queue.get_nowait()
+        self.assertIn('INSERT OR REPLACE INTO images', sql)
+        self.assertEqual(params[:2], (image_path, len(image_data)))
+
+class TestCropToObject(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        index.config = {
+            'frigate': {'detect_resolution': {'camera2': [320, 240]}},
+            'fast_alpr': {'crop_to_object': True, 'crop_padding': 0.5, 'crop_min_size': 50},
+        }
+        self.frame = index.Frame(make_jpeg(640, 480))
+
+    def test_crop_box_padded_around_object(self):
+        after_data = {'id': 'event1', 'camera': 'camera1', 'box': [100, 100, 200, 140]}
+        self.assertEqual(index.get_crop_box(self.frame, after_data), (50, 80, 250, 160))
+
+    def test_crop_box_scaled_from_detect_resolution(self):
+        after_data = {'id': 'event1', 'camera': 'camera2', 'box': [50, 50, 100, 70]}
+        self.assertEqual(index.get_crop_box(self.frame, after_data), (50, 80, 250, 160))
+
+    def test_crop_box_kept_inside_frame(self):
+        after_data = {'id': 'event1', 'camera': 'camera1', 'box': [0, 0, 10, 10]}
+        self.assertEqual(index.get_crop_box(self.frame, after_data), (0, 0, 50, 50))
+
+    @patch('index.get_alpr')
+    def test_results_mapped_to_full_frame(self, mock_get_alpr):
+        mock_get_alpr.return_value.predict.return_value = [make_alpr_result(box=(10, 10, 40, 20))]
+        after_data = {'id': 'event1', 'camera': 'camera1', 'box': [100, 100, 200, 140]}
+
+        results = index.predict_plates(self.frame, after_data)
+
+        self.assertEqual(mock_get_alpr.return_value.predict.call_args[0][0].shape, (80, 200, 3))
+        self.assertEqual(results[0].detection.bounding_box, BoundingBox(60, 90, 90, 100))
+
+    @patch('index.get_alpr')
+    def test_falls_back_to_full_frame(self, mock_get_alpr):
+        mock_get_alpr.return_value.predict.side_effect = [[], [make_alpr_result()]]
+        after_data = {'id': 'event1', 'camera': 'camera1', 'box': [100, 100, 200, 140]}
+
+        results = index.predict_plates(self.frame, after_data)
+
+        self.assertEqual(mock_get_alpr.return_value.predict.call_args[0][0].shape, (480, 640, 3))
+        self.assertEqual(results, [make_alpr_result()])
+
+class TestFrigateClient(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = index.FrigateClient('http://example.com', connect_timeout=1, read_timeout=5, retries=2)
+        self.client.session = MagicMock()
+
+    def mock_response(self, status_code, content=b'image_data'):
+        response = MagicMock()
+        response.status_code = status_code
+        response.content = content
+        return response
+
+    def test_latest_snapshot(self):
+        self.client.session.get.return_value = self.mock_response(200)
+
+        snapshot = self.client.get_snapshot('event123', 'camera1', {'height': 720, 'quality': 90})
+
+        self.assertEqual(snapshot, b'image_data')
+        self.client.session.get.assert_called_once_with('http://example.com/api/camera1/latest.jpg',
+                                                        params={'quality': 90, 'h': 720}, timeout=(1, 5))
+
+    def test_event_snapshot_sources(self):
+        self.client.session.get.return_value = self.mock_response(200)
+
+        self.client.get_snapshot('event123', 'camera1', {'source': 'snapshot', 'crop': True})
+        self.client.session.get.assert_called_with('http://example.com/api/events/event123/snapshot.jpg',
+                                                   params={'quality': 100, 'crop': 1}, timeout=(1, 5))
+
+        self.client.get_snapshot('event123', 'camera1', {'source': 'snapshot_clean'})
+        self.client.session.get.assert_called_with('http://example.com/api/events/event123/snapshot-clean.png',
+                                                   params={'crop': 0}, timeout=(1, 5))
+
+    @patch('index.time.sleep')
+    def test_retries_server_errors(self, mock_sleep):
+        self.client.session.get.side_effect = [index.requests.ConnectionError(), self.mock_response(503), self.mock_response(200)]
+
+        snapshot = self.client.get_snapshot('event123', 'camera1', {})
+
+        self.assertEqual(snapshot, b'image_data')
+        self.assertEqual(mock_sleep.call_count, 2)
+
+    @patch('index.time.sleep')
+    def test_failed_snapshot(self, mock_sleep):
+        self.client.session.get.return_value = self.mock_response(404)
+
+        self.assertIsNone(self.client.get_snapshot('event123', 'camera1', {}))
+        self.client.session.get.assert_called_once()
+        self.mock_logger.error.assert_called_with("Error getting snapshot: 404")
+
+    def test_camera_snapshot_config(self):
+        index.config = {'frigate': {'snapshot': {'source': 'latest', 'height': 720, 'cameras': {'camera1': {'source': 'snapshot', 'crop': True}}}}}
+
+        self.assertEqual(index.get_snapshot_config('camera1'), {'source': 'snapshot', 'height': 720, 'crop': True})
+        self.assertEqual(index.get_snapshot_config('camera2'), {'source': 'latest', 'height': 720})
+        self.assertIsNone(index.get_object_box({'camera': 'camera1', 'box': [0, 0, 1, 1]}))
+        self.assertEqual(index.get_object_box({'camera': 'camera2', 'box': [0, 0, 1, 1]}), [0, 0, 1, 1])
+
+class TestIsDuplicateFrame(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        index.LAST_FRAMES.clear()
+        index.FRAME_DEDUP_STATS.update(exact=0, similar=0, processed=0)
+        index.config = {'frigate': {'frame_diff_threshold': 2.0}, 'fast_alpr': {}}
+        self.after_data = {'id': 'event1', 'camera': 'camera1'}
+
+    def make_frame(self, value, seed=0):
+        image = np.random.default_rng(seed).integers(0, 8, (240, 320, 3), dtype=np.uint8) + value
+        return index.Frame(cv2.imencode('.png', image)[1].tobytes())
+
+    def test_exact_duplicate_skipped_without_decoding(self):
+        self.assertFalse(index.is_duplicate_frame('event1', self.make_frame(100), self.after_data))
+
+        frame = self.make_frame(100)
+        self.assertTrue(index.is_duplicate_frame('event1', frame, self.after_data))
+        self.assertIsNone(frame._image)
+        self.assertEqual(index.get_frame_dedup_stats(), {'exact': 1, 'similar': 0, 'processed': 1})
+
+    def test_similar_frame_skipped(self):
+        self.assertFalse(index.is_duplicate_frame('event1', self.make_frame(100), self.after_data))
+        self.assertTrue(index.is_duplicate_frame('event1', self.make_frame(100, seed=1), self.after_data))
+        self.assertEqual(index.get_frame_dedup_stats()['similar'], 1)
+
+    def test_changed_frame_processed(self):
+        self.assertFalse(index.is_duplicate_frame('event1', self.make_frame(100), self.after_data))
+        self.assertFalse(index.is_duplicate_frame('event1', self.make_frame(150), self.after_data))
+        self.assertFalse(index.is_duplicate_frame('event2', self.make_frame(150), self.after_data))
+        self.assertEqual(index.get_frame_dedup_stats()['processed'], 3)
+
+    def test_disabled(self):
+        index.config['frigate']['frame_dedup'] = False
+        self.assertFalse(index.is_duplicate_frame('event1', self.make_frame(100), self.after_data))
+        self.assertFalse(index.is_duplicate_frame('event1', self.make_frame(100), self.after_data))
+
+class TestPlateVoting(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        index.PLATE_READS.clear()
+        index.config = {'fast_alpr': {'vote_min_frames': 3, 'vote_threshold': 0.7}}
+
+    def test_characters_voted_by_confidence(self):
+        index.add_plate_read('event1', 'ABC123', 0.9)
+        index.add_plate_read('event1', 'A8C123', 0.5)
+        consensus = index.add_plate_read('event1', 'ABC128', 0.6)
+
+        self.assertEqual(consensus['plate'], 'ABC123')
+        self.assertEqual(consensus['votes'], 3)
+        self.assertAlmostEqual(consensus['score'], 2.0 / 3)
+        self.assertAlmostEqual(consensus['agreement'], 0.7)
+        self.assertTrue(consensus['converged'])
+
+    def test_reads_without_confidence_are_counted(self):
+        index.add_plate_read('event1', 'ABC12', 0)
+        index.add_plate_read('event1', 'ABC123', 0)
+        consensus = index.add_plate_read('event1', 'ABC124', 0)
+
+        self.assertEqual(consensus['plate'], 'ABC123')
+        self.assertEqual(consensus['votes'], 2)
+        self.assertAlmostEqual(consensus['agreement'], 0.5)
+        self.assertEqual(consensus['score'], 0)
+
+    def test_most_supported_length_wins(self):
+        index.add_plate_read('event1', 'ABC123', 0.8)
+        consensus = index.add_plate_read('event1', 'ABC1234', 0.9)
+        self.assertEqual(consensus['plate'], 'ABC1234')
+
+        consensus = index.add_plate_read('event1', 'ABC124', 0.8)
+        self.assertEqual(consensus['plate'], 'ABC123')
+        self.assertEqual(consensus['votes'], 2)
+
+    def test_per_character_confidence(self):
+        index.add_plate_read('event1', 'ABC123', [0.9, 0.9, 0.9, 0.9, 0.9, 0.2])
+        consensus = index.add_plate_read('event1', 'ABC128', [0.5, 0.5, 0.5, 0.5, 0.5, 0.9])
+        self.assertEqual(consensus['plate'], 'ABC128')
+
+    def test_not_converged_until_enough_frames_agree(self):
+        self.assertFalse(index.add_plate_read('event1', 'ABC123', 0.9)['converged'])
+        self.assertFalse(index.add_plate_read('event1', 'ABC123', 0.9)['converged'])
+        self.assertFalse(index.add_plate_read('event1', 'XYZ789', 0.9)['converged'])
+        self.assertFalse(index.add_plate_read('event2', 'ABC123', 0.9)['converged'])
+
+class TestCheckWatchedPlates(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        index.config = {'frigate': {'watched_plates': ['ABC123', 'xyz789', 'DEF456'], 'fuzzy_match': 0.8}}
+        index.build_watched_plate_matcher()
+
+    def test_exact_match(self):
+        self.assertEqual(index.check_watched_plates('abc123'), ('ABC123', 1.0))
+
+    def test_ocr_confusions_match_exactly(self):
+        self.assertEqual(index.check_watched_plates('XYZ7B9'), ('xyz789', 1.0))
+        self.assertEqual(index.check_watched_plates('A8C-I23'), ('ABC123', 1.0))
+
+    def test_fuzzy_match(self):
+        watched_plate, score = index.check_watched_plates('DEF457')
+        self.assertEqual(watched_plate, 'DEF456')
+        self.assertAlmostEqual(score, 5 / 6)
+
+    def test_no_match(self):
+        self.assertEqual(index.check_watched_plates('QRS000'), (None, None))
+
+    def test_fuzzy_match_disabled(self):
+        index.config['frigate']['fuzzy_match'] = 0
+        self.assertEqual(index.check_watched_plates('DEF457'), (None, None))
+
+    def test_no_watched_plates(self):
+        index.config = {'frigate': {}}
+        index.build_watched_plate_matcher()
+        self.assertEqual(index.check_watched_plates('ABC123'), (None, None))
+
+    def test_match_on_threshold(self):
+        matcher = index.PlateMatcher(['ABCDE'])
+        self.assertEqual(matcher.match('ABCD', 0.8), [('ABCDE', 0.8)])
+        self.assertEqual(matcher.match('ABCDEFGH', 0.625), [('ABCDE', 0.625)])
+
+    def test_fuzzy_scores(self):
+        # 1 - edit distance / length of the longer plate
+        matcher = index.PlateMatcher(['ABC123'])
+        self.assertAlmostEqual(matcher.match('ABC124', 0.5)[0][1], 5 / 6)
+        self.assertAlmostEqual(matcher.match('ABC12', 0.5)[0][1], 5 / 6)
+        self.assertAlmostEqual(matcher.match('ABC1234', 0.5)[0][1], 6 / 7)
+        self.assertAlmostEqual(matcher.match('XBC124', 0.5)[0][1], 4 / 6)
+
+    def test_top_k_matches_with_scores(self):
+        matcher = index.PlateMatcher(['ABC123', 'ABC124', 'ABD124', 'ZZZ999'])
+        matches = matcher.match('ABC125', 0.6, top_k=2)
+        self.assertEqual([plate for plate, _ in matches], ['ABC123', 'ABC124'])
+        self.assertEqual(len(matcher.match('ABC125', 0.6, top_k=10)), 3)
+
+    def test_index_agrees_with_linear_scan(self):
+        rng = np.random.default_rng(0)
+        alphabet = list('ACEFHJKMNPRTUVWXY34679')
+        plates = [''.join(rng.choice(alphabet, 6)) for _ in range(500)]
+        matcher = index.PlateMatcher(plates)
+        for query in plates[:50]:
+            for query, min_score in [(query[:-1] + 'W', 5 / 6), (query[1:] + 'W', 4 / 6), (query[:3], 0.5)]:
+                radius = int(len(query) * (1 - min_score) / min_score)
+                expected = sorted(plate for plate in plates if index.levenshtein_distance(query, plate) <= radius
+                                  and 1 - index.levenshtein_distance(query, plate) / max(len(query), len(plate)) >= min_score)
+                self.assertEqual(sorted(plate for plate, _ in matcher.match(query, min_score, top_k=len(plates))), expected)
+
+class TestBatchedInference(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        index.config = {'fast_alpr': {'plate_detector_model': 'detector', 'ocr_model': 'ocr'}}
+
+    @patch('index.get_alpr')
+    def test_plates_from_all_images_share_one_ocr_run(self, mock_get_alpr):
+        alpr = mock_get_alpr.return_value
+        detection1 = make_alpr_result(box=(0, 0, 20, 10)).detection
+        detection2 = make_alpr_result(box=(10, 10, 40, 20)).detection
+        alpr.detector.predict.side_effect = [[detection1, detection2], [], [detection1]]
+        alpr.ocr.ocr_model.run.return_value = (['ABC123__', 'DEF456__', 'GHI789__'], np.array([[0.5, 0.7], [0.6, 0.6], [0.9, 0.9]]))
+        images = [np.zeros((48, 64, 3), np.uint8) for _ in range(3)]
+
+        results = index.predict_batch(images)
+
+        gray_plates = alpr.ocr.ocr_model.run.call_args[0][0]
+        self.assertEqual([plate.shape for plate in gray_plates], [(10, 20), (10, 30), (10, 20)])
+        self.assertEqual([[result.ocr.text for result in image_results] for image_results in results],
+                         [['ABC123', 'DEF456'], [], ['GHI789']])
+        self.assertAlmostEqual(results[0][0].ocr.confidence, 0.6)
+        self.assertEqual(results[0][1].detection, detection2)
+
+    @patch('index.read_plates')
+    @patch('index.get_alpr')
+    def test_batcher_groups_waiting_plates(self, mock_get_alpr, mock_read_plates):
+        mock_read_plates.side_effect = lambda plates: [OcrResult(text=str(plate), confidence=0.9) for plate in plates]
+        batcher = index.InferenceBatcher(max_batch_size=3, max_wait=5)
+
+        futures = [batcher.submit(plates) for plates in [['plate1', 'plate2'], ['plate3']]]
+
+        self.assertEqual([[result.text for result in future.result(timeout=5)] for future in futures],
+                         [['plate1', 'plate2'], ['plate3']])
+        mock_read_plates.assert_called_once_with(['plate1', 'plate2', 'plate3'])
+
+    @patch('index.read_plates')
+    @patch('index.get_alpr')
+    def test_detection_runs_in_calling_thread(self, mock_get_alpr, mock_read_plates):
+        detection = make_alpr_result(box=(0, 0, 20, 10)).detection
+        mock_get_alpr.return_value.detector.predict.return_value = [detection]
+        mock_read_plates.return_value = [OcrResult(text='ABC123', confidence=0.9)]
+        batcher = index.InferenceBatcher(max_batch_size=8, max_wait=0.01)
+
+        results = batcher.predict(np.zeros((48, 64, 3), np.uint8))
+
+        self.assertEqual(results, [ALPRResult(detection=detection, ocr=OcrResult(text='ABC123', confidence=0.9))])
+        self.assertEqual(mock_read_plates.call_args[0][0][0].shape, (10, 20, 3))
+
+    @patch('index.read_plates')
+    def test_batcher_flushes_after_max_wait(self, mock_read_plates):
+        mock_read_plates.return_value = [OcrResult(text='ABC123', confidence=0.9)]
+        batcher = index.InferenceBatcher(max_batch_size=8, max_wait=0.01)
+
+        self.assertEqual(batcher.submit(['plate1']).result(timeout=5), [OcrResult(text='ABC123', confidence=0.9)])
+
+    @patch('index.read_plates')
+    def test_batcher_propagates_errors(self, mock_read_plates):
+        mock_read_plates.side_effect = RuntimeError("inference failed")
+        batcher = index.InferenceBatcher(max_batch_size=1, max_wait=0)
+
+        with self.assertRaises(RuntimeError):
+            batcher.submit(['plate1']).result(timeout=5)
+
+    def test_stopped_batcher_fails_new_plates(self):
+        batcher = index.InferenceBatcher(max_batch_size=1, max_wait=0)
+        batcher.stop()
+        batcher.thread.join(timeout=5)
+
+        with self.assertRaises(RuntimeError):
+            batcher.submit(['plate1']).result(timeout=1)
+
+    @patch('index.setup_inference')
+    @patch('index.preload_alpr_models')
+    def test_reload_sets_up_inference_only_for_inference_settings(self, mock_preload_alpr_models, mock_setup_inference):
+        index.config = {'frigate': {}, 'fast_alpr': {'plate_detector_model': 'detector', 'ocr_model': 'ocr', 'batch_size': 8}}
+        new_config = copy.deepcopy(index.config)
+        new_config['fast_alpr']['vote_threshold'] = 0.8
+        with patch('builtins.open', mock_open(read_data=yaml.dump(new_config))):
+            index.reload_config()
+        mock_setup_inference.assert_not_called()
+
+        new_config['fast_alpr']['batch_size'] = 4
+        with patch('builtins.open', mock_open(read_data=yaml.dump(new_config))):
+            index.reload_config()
+        mock_setup_inference.assert_called_once()
+        mock_preload_alpr_models.assert_not_called()
+
+class TestProcessInference(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        index.config = {'fast_alpr': {'plate_detector_model': 'detector', 'ocr_model': 'ocr'}}
+        index.inference_batcher = None
+        index.process_pool = None
+
+    def tearDown(self):
+        index.process_pool = None
+
+    @patch('index.get_alpr')
+    def test_frames_passed_through_shared_memory(self, mock_get_alpr):
+        received = {}
+        def predict(image):
+            received['image'] = image.copy()
+            return [make_alpr_result()]
+        mock_get_alpr.return_value.predict.side_effect = predict
+        shm_names = []
+        original_shared_memory = index.shared_memory.SharedMemory
+        def track_shared_memory(*args, **kwargs):
+            shm = original_shared_memory(*args, **kwargs)
+            shm_names.append(shm.name)
+            return shm
+        image = np.arange(48 * 64 * 3, dtype=np.uint8).reshape((48, 64, 3))[10:30, 5:50]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool, \
+                patch('index.shared_memory.SharedMemory', side_effect=track_shared_memory):
+            index.process_pool = pool
+            results = index.run_alpr(image)
+
+        self.assertEqual(results, [make_alpr_result()])
+        np.testing.assert_array_equal(received['image'], image)
+        with self.assertRaises(FileNotFoundError):
+            original_shared_memory(name=shm_names[0])
+
+    @patch('index.get_available_cores', return_value=16)
+    @patch('index.concurrent.futures.ProcessPoolExecutor')
+    def test_process_pool_sized_to_cores(self, mock_process_pool, mock_get_available_cores):
+        index.config['fast_alpr']['inference_mode'] = 'process'
+
+        index.setup_inference()
+
+        kwargs = mock_process_pool.call_args.kwargs
+        self.assertEqual(kwargs['max_workers'], 16)
+        self.assertEqual(kwargs['mp_context'].get_start_method(), 'spawn')
+        self.assertIs(kwargs['initializer'], index.init_inference_process)
+        self.assertEqual(kwargs['initargs'][0]['fast_alpr']['intra_op_threads'], 1)
+        self.assertNotIn('intra_op_threads', index.config['fast_alpr'])
+        self.assertIs(index.process_pool, mock_process_pool.return_value)
+
+    def test_broken_pool_is_restarted_with_backoff(self):
+        def fail():
+            raise RuntimeError("model download failed")
+        broken_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, initializer=fail)
+        working_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        index.process_pool = broken_pool
+        index.PROCESS_POOL_STATE.update(failures=0, retry_at=None)
+
+        with patch('index.create_process_pool', return_value=working_pool) as mock_create_process_pool:
+            with self.assertRaises(concurrent.futures.BrokenExecutor):
+                index.run_in_process_pool(len, 'abc')
+            with self.assertRaises(RuntimeError):
+                index.run_in_process_pool(len, 'abc')
+            mock_create_process_pool.assert_not_called()
+
+            index.PROCESS_POOL_STATE['retry_at'] = time.monotonic()
+            self.assertEqual(index.run_in_process_pool(len, 'abc'), 3)
+
+        self.assertIs(index.process_pool, working_pool)
+        self.assertEqual(index.PROCESS_POOL_STATE, {'failures': 0, 'retry_at': None})
+        working_pool.shutdown()
+
+    @patch('index.create_process_pool')
+    def test_reload_keeps_pool_without_process_changes(self, mock_create_process_pool):
+        index.config['fast_alpr']['inference_mode'] = 'process'
+        index.setup_inference()
+        pool = index.process_pool
+
+        index.setup_inference(restart_pool=False)
+
+        self.assertIs(index.process_pool, pool)
+        mock_create_process_pool.assert_called_once()
+        pool.shutdown.assert_not_called()
+
+class TestAsyncRuntime(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        index.ASYNC_EVENTS.clear()
+        index.RESOLVED_EVENTS.clear()
+        index.config = {'frigate': {'frigate_url': 'http://example.com', 'attempt_interval': 0, 'max_attempts': 5}}
+        self.is_duplicate_event = patch('index.is_duplicate_event', return_value=False)
+        self.is_duplicate_event.start()
+
+    def tearDown(self):
+        self.is_duplicate_event.stop()
+
+    def make_message(self, event_type, frigate_event_id='event1'):
+        after_data = {'id': frigate_event_id, 'camera': 'camera1', 'label': 'car', 'current_zones': []}
+        return MagicMock(payload=json.dumps({'type': event_type, 'before': after_data, 'after': after_data}))
+
+    def run_async(self, coroutine):
+        return asyncio.run(asyncio.wait_for(coroutine, timeout=5))
+
+    @patch('index.recognize_snapshot', return_value=False)
+    @patch('index.get_snapshot', return_value=b'image_data')
+    def test_updates_trigger_attempts_until_end(self, mock_get_snapshot, mock_recognize_snapshot):
+        async def scenario():
+            with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+                await index.dispatch_async_message(self.make_message('new'), pool, pool)
+                event = index.ASYNC_EVENTS['event1']
+                while event['attempts'] < 1:
+                    await asyncio.sleep(0.01)
+                await asyncio.sleep(0.05)
+                self.assertEqual(event['attempts'], 1)
+
+                await index.dispatch_async_message(self.make_message('update'), pool, pool)
+                while event['attempts'] < 2:
+                    await asyncio.sleep(0.01)
+
+                await index.dispatch_async_message(self.make_message('end'), pool, pool)
+                with self.assertRaises(asyncio.CancelledError):
+                    await event['task']
+        self.run_async(scenario())
+
+        self.assertNotIn('event1', index.ASYNC_EVENTS)
+        mock_get_snapshot.assert_called_with('event1', 'camera1')
+        self.assertEqual(mock_recognize_snapshot.call_count, 2)
+
+    @patch('index.recognize_snapshot', return_value=True)
+    @patch('index.get_snapshot', return_value=b'image_data')
+    def test_event_stops_when_plate_resolved(self, mock_get_snapshot, mock_recognize_snapshot):
+        async def scenario():
+            with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+                await index.dispatch_async_message(self.make_message('new'), pool, pool)
+                await index.ASYNC_EVENTS['event1']['task']
+        self.run_async(scenario())
+
+        self.assertNotIn('event1', index.ASYNC_EVENTS)
+        mock_recognize_snapshot.assert_called_once_with(
+            {'id': 'event1', 'camera': 'camera1', 'label': 'car', 'current_zones': []}, 'http://example.com', 'event1', b'image_data')
+
+    @patch('index.recognize_snapshot', return_value=False)
+    @patch('index.get_snapshot', return_value=b'image_data')
+    def test_event_deadline(self, mock_get_snapshot, mock_recognize_snapshot):
+        index.config['frigate']['event_timeout'] = 0.05
+
+        async def scenario():
+            with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+                await index.dispatch_async_message(self.make_message('new'), pool, pool)
+                await index.ASYNC_EVENTS['event1']['task']
+        self.run_async(scenario())
+
+        self.assertNotIn('event1', index.ASYNC_EVENTS)
+
+    def test_full_queue_drops_messages(self):
+        index.INGEST_STATS['dropped'] = 0
+        async def scenario():
+            message_queue = asyncio.Queue(maxsize=1)
+            index.enqueue_async_message(message_queue, self.make_message('new'))
+            index.enqueue_async_message(message_queue, self.make_message('update'))
+            return message_queue.qsize()
+        self.assertEqual(self.run_async(scenario()), 1)
+        self.assertEqual(index.INGEST_STATS['dropped'], 1)
+
+    def test_full_queue_keeps_end_messages(self):
+        end_message = self.make_message('end')
+        async def scenario():
+            message_queue = asyncio.Queue(maxsize=1)
+            index.enqueue_async_message(message_queue, self.make_message('new'))
+            index.enqueue_async_message(message_queue, end_message)
+            self.assertEqual(len(index.pending_end_messages), 1)
+            await message_queue.get()
+            return await message_queue.get()
+        self.assertIs(self.run_async(scenario()), end_message)
+        self.assertEqual(index.pending_end_messages, set())
+
+    def test_duplicate_check_runs_off_the_event_loop(self):
+        threads = []
+        self.is_duplicate_event.stop()
+        async def scenario():
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool, \
+                    patch('index.is_duplicate_event', side_effect=lambda event_id: threads.append(threading.current_thread()) or True):
+                await index.dispatch_async_message(self.make_message('new'), pool, pool)
+        self.run_async(scenario())
+        self.is_duplicate_event.start()
+
+        self.assertNotIn('event1', index.ASYNC_EVENTS)
+        self.assertIsNot(threads[0], threading.current_thread())
+
+    def test_mqtt_socket_driven_by_event_loop(self):
+        loop = MagicMock()
+        client = MagicMock()
+        helper = index.AsyncioMqttHelper(loop, client)
+
+        helper.on_socket_open(client, None, 'sock')
+        loop.add_reader.assert_called_once_with('sock', client.loop_read)
+        helper.on_socket_register_write(client, None, 'sock')
+        loop.call_soon_threadsafe.assert_called_with(loop.add_writer, 'sock', client.loop_write)
+        helper.on_socket_close(client, None, 'sock')
+        loop.remove_reader.assert_called_once_with('sock')
+        loop.create_task.return_value.cancel.assert_called_once()
+        loop.create_task.call_args[0][0].close()
+
+class TestHomeAssistantDiscovery(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        index.config = {'frigate': {'main_topic': 'frigate'}}
+        self.vehicle_data = {key: f'value_{key}' for key in index.VEHICLE_DATA_KEYS}
+
+    def test_discovery_published_on_connect(self):
+        client = MagicMock()
+        index.on_connect(client, None, None, 0, None)
+
+        client.subscribe.assert_any_call('frigate/events')
+        client.subscribe.assert_any_call('homeassistant/status')
+        topics = [call.args[0] for call in client.publish.call_args_list]
+        self.assertEqual(len(topics), len(index.VEHICLE_DATA_KEYS))
+        self.assertIn('homeassistant/binary_sensor/vehicle_data/matched/config', topics)
+        self.assertIn('homeassistant/camera/vehicle_data/plate_image/config', topics)
+        for call in client.publish.call_args_list:
+            self.assertTrue(call.kwargs['retain'])
+
+    def test_discovery_republished_when_home_assistant_restarts(self):
+        client = MagicMock()
+        index.on_message(client, None, MagicMock(topic='homeassistant/status', payload=b'offline'))
+        client.publish.assert_not_called()
+
+        index.on_message(client, None, MagicMock(topic='homeassistant/status', payload=b'online'))
+        self.assertEqual(client.publish.call_count, len(index.VEHICLE_DATA_KEYS))
+
+    @patch('index.mqtt_client', create=True)
+    def test_states_published_per_key(self, mock_mqtt_client):
+        index.config['homeassistant'] = {'qos': 1}
+        index.publish_states(self.vehicle_data)
+
+        self.assertEqual(mock_mqtt_client.publish.call_count, len(index.VEHICLE_DATA_KEYS))
+        mock_mqtt_client.publish.assert_any_call(
+            'homeassistant/sensor/vehicle_data/camera_name/state', 'value_camera_name', qos=1, retain=True)
+
+    @patch('index.mqtt_client', create=True)
+    def test_states_published_as_json(self, mock_mqtt_client):
+        index.config['homeassistant'] = {'json_state': True, 'discovery_prefix': 'ha'}
+        index.publish_states(self.vehicle_data)
+
+        self.assertEqual(mock_mqtt_client.publish.call_count, 2)
+        topic, payload = mock_mqtt_client.publish.call_args_list[0].args
+        self.assertEqual(topic, 'ha/sensor/vehicle_data/state')
+        state = json.loads(payload)
+        self.assertEqual(state['camera_name'], 'value_camera_name')
+        self.assertNotIn('plate_image', state)
+        mock_mqtt_client.publish.assert_called_with(
+            'ha/camera/vehicle_data/plate_image/state', 'value_plate_image', qos=0, retain=True)
+
+    def test_json_state_discovery_uses_value_templates(self):
+        index.config['homeassistant'] = {'json_state': True}
+        payloads = dict(index.get_discovery_payloads())
+
+        matched = payloads['homeassistant/binary_sensor/vehicle_data/matched/config']
+        self.assertEqual(matched['state_topic'], 'homeassistant/sensor/vehicle_data/state')
+        self.assertEqual(matched['value_template'], '{{ value_json.matched }}')
+        plate_image = payloads['homeassistant/camera/vehicle_data/plate_image/config']
+        self.assertEqual(plate_image['state_topic'], 'homeassistant/camera/vehicle_data/plate_image/state')
+        self.assertNotIn('value_template', plate_image)
+
+
+class TestDelayedActions(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.delayed_actions = index.DelayedActions()
+        self.ran = []
+        self.done = threading.Event()
+
+    def tearDown(self):
+        self.delayed_actions.stop()
+        self.delayed_actions.thread.join(timeout=1)
+
+    def action(self, name):
+        def run():
+            self.ran.append((name, time.monotonic()))
+            self.done.set()
+        return run
+
+    def test_action_runs_after_delay(self):
+        start = time.monotonic()
+        self.delayed_actions.schedule('topic', 0.05, self.action('reset'))
+        self.assertTrue(self.done.wait(1))
+        self.assertEqual([name for name, _ in self.ran], ['reset'])
+        self.assertGreaterEqual(self.ran[0][1] - start, 0.05)
+
+    def test_reschedule_extends_pending_action(self):
+        start = time.monotonic()
+        self.delayed_actions.schedule('topic', 0.05, self.action('first'))
+        self.delayed_actions.schedule('topic', 0.15, self.action('second'))
+        self.assertTrue(self.done.wait(1))
+        time.sleep(0.1)
+        self.assertEqual([name for name, _ in self.ran], ['second'])
+        self.assertGreaterEqual(self.ran[0][1] - start, 0.15)
+
+    def test_cancel(self):
+        self.delayed_actions.schedule('topic', 0.02, self.action('reset'))
+        self.delayed_actions.cancel('topic')
+        self.assertFalse(self.done.wait(0.1))
+        self.assertEqual(self.ran, [])
+
+    def test_keys_are_independent(self):
+        self.delayed_actions.schedule('topic1', 0.02, self.action('first'))
+        self.delayed_actions.schedule('topic2', 0.01, self.action('second'))
+        time.sleep(0.1)
+        self.assertEqual([name for name, _ in self.ran], ['second', 'first'])
+
+    @patch('index.mqtt_client', create=True)
+    @patch('index.executor')
+    def test_match_schedules_reset_without_worker(self, mock_executor, mock_mqtt_client):
+        index.config = {'homeassistant': {'matched_reset_delay': 0.05}}
+        index.delayed_actions = self.delayed_actions
+        index.send_mqtt_message('ABC123', 0.9, 'event1', {'camera': 'camera1'}, 'ABC123', ['ABC123'], 1.0, b'image')
+        index.send_mqtt_message('ABC123', 0.9, 'event2', {'camera': 'camera1'}, 'ABC123', ['ABC123'], 1.0, b'image')
+
+        mock_executor.submit.assert_called_with(index.publish_states, ANY)
+        self.assertEqual(mock_executor.submit.call_count, 2)
+        time.sleep(0.2)
+        mock_mqtt_client.publish.assert_called_once_with(
+            'homeassistant/binary_sensor/vehicle_data/matched/state', False, qos=0, retain=True)
+
+
+class TestImageRetention(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = patch.object(index, 'DB_PATH', os.path.join(self.tmp_dir.name, 'plates.db'))
+        self.db_path.start()
+        index.db_local = threading.local()
+        index.RETENTION_STATS.update(deleted=0, deleted_bytes=0, failed=0)
+        index.setup_db()
+        self.snapshot_path = patch('index.SNAPSHOT_PATH', os.path.join(self.tmp_dir.name, 'plates'))
+        self.snapshot_path.start()
+        self.db_write_queue = patch('index.db_write_queue', queue.Queue())
+        self.db_write_queue.start()
+        os.makedirs(index.SNAPSHOT_PATH)
+        index.config = {'retention_batch_size': 2}
+
+    def tearDown(self):
+        self.db_write_queue.stop()
+        self.snapshot_path.stop()
+        index.db_local.conn.close()
+        index.db_local = threading.local()
+        self.db_path.stop()
+        self.tmp_dir.cleanup()
+
+    def add_image(self, name, size, age_days):
+        image_path = os.path.join(index.SNAPSHOT_PATH, name)
+        with open(image_path, 'wb') as image_file:
+            image_file.write(b'x' * size)
+        index.index_image(image_path, size, time.time() - age_days * 86400)
+        index.write_db_batch([index.db_write_queue.get_nowait()])
+        return image_path
+
+    def get_indexed_paths(self):
+        return [path for (path,) in index.get_db_connection().execute("SELECT path FROM images ORDER BY created")]
+
+    def test_deletes_images_older_than_days_to_keep(self):
+        old_images = [self.add_image(f'old{i}.png', 10, 10 + i) for i in range(5)]
+        new_image = self.add_image('new.png', 10, 1)
+        index.config['days_to_keep_images'] = 7
+
+        with patch('os.listdir') as mock_listdir:
+            index.delete_old_images()
+            mock_listdir.assert_not_called()
+
+        for image_path in old_images:
+            self.assertFalse(os.path.exists(image_path))
+        self.assertTrue(os.path.exists(new_image))
+        self.assertEqual(self.get_indexed_paths(), [new_image])
+        self.assertEqual(index.get_retention_stats(), {'deleted': 5, 'deleted_bytes': 50, 'failed': 0})
+
+    def test_deletes_oldest_images_over_quota(self):
+        images = [self.add_image(f'image{i}.png', 100, 5 - i) for i in range(5)]
+        index.config['max_image_bytes'] = 250
+
+        index.delete_old_images()
+
+        self.assertEqual(self.get_indexed_paths(), images[3:])
+        self.assertFalse(any(os.path.exists(image_path) for image_path in images[:3]))
+
+    def test_missing_files_are_removed_from_index(self):
+        image_path = self.add_image('image.png', 10, 10)
+        os.remove(image_path)
+        index.config['days_to_keep_images'] = 7
+
+        index.delete_old_images()
+
+        self.assertEqual(self.get_indexed_paths(), [])
+        self.assertEqual(index.RETENTION_STATS['failed'], 0)
+
+    def test_failed_deletes_stay_in_index(self):
+        images = [self.add_image(f'image{i}.png', 10, 10 + i) for i in range(3)]
+        index.config['days_to_keep_images'] = 7
+        original_remove = os.remove
+        def remove(path):
+            if path == images[0]:
+                raise PermissionError("read only")
+            original_remove(path)
+
+        with patch('os.remove', side_effect=remove):
+            index.delete_old_images()
+
+        self.assertTrue(os.path.exists(images[0]))
+        self.assertEqual(self.get_indexed_paths(), [images[0]])
+        self.assertEqual(index.get_retention_stats(), {'deleted': 2, 'deleted_bytes': 20, 'failed': 1})
+
+    def test_empty_partition_folders_removed(self):
+        image_dir = os.path.join(index.SNAPSHOT_PATH, '2020-01-01', 'camera1')
+        os.makedirs(image_dir)
+        self.add_image(os.path.join('2020-01-01', 'camera1', 'image.png'), 10, 10)
+        index.config['days_to_keep_images'] = 7
+
+        index.delete_old_images()
+
+        self.assertEqual(os.listdir(index.SNAPSHOT_PATH), [])
+
+    def test_existing_images_indexed_once(self):
+        os.makedirs(os.path.join(index.SNAPSHOT_PATH, 'camera1'))
+        for name in ['image1.png', os.path.join('camera1', 'image2.png')]:
+            with open(os.path.join(index.SNAPSHOT_PATH, name), 'wb') as image_file:
+                image_file.write(b'x')
+
+        index.index_existing_images()
+        self.assertEqual(len(self.get_indexed_paths()), 2)
+
+        with patch('os.walk') as mock_walk:
+            index.index_existing_images()
+            mock_walk.assert_not_called()
+
+
+class TestMetrics(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        for histogram in index.STAGE_DURATIONS.values():
+            histogram.counts = [0] * (len(histogram.buckets) + 1)
+            histogram.sum = 0.0
+        index.EVENT_COUNTERS.update(received=0, filtered=0, deduped=0, matched=0)
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = index.Histogram(buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value)
+
+        counts, total = histogram.snapshot()
+        self.assertEqual(counts, [2, 3, 4])
+        self.assertAlmostEqual(total, 2.65)
+
+    def test_stage_timing(self):
+        with index.stage('snapshot'):
+            time.sleep(0.01)
+
+        metrics = index.render_metrics()
+        self.assertIn('plate_recognizer_stage_duration_seconds_bucket{stage="snapshot",le="0.025"} 1', metrics)
+        self.assertIn('plate_recognizer_stage_duration_seconds_count{stage="snapshot"} 1', metrics)
+        self.assertIn('plate_recognizer_stage_duration_seconds_count{stage="ocr"} 0', metrics)
+
+    def test_filtered_events_counted(self):
+        index.config = {'frigate': {'camera': ['camera1']}}
+        after_data = {'id': 'event1', 'camera': 'camera2', 'label': 'car', 'current_zones': []}
+        message = MagicMock(payload=json.dumps({'type': 'new', 'before': after_data, 'after': after_data}))
+
+        self.assertIsNone(index.parse_event_message(message))
+
+        metrics = index.render_metrics()
+        self.assertIn('plate_recognizer_events_total{result="received"} 1', metrics)
+        self.assertIn('plate_recognizer_events_total{result="filtered"} 1', metrics)
+
+    @patch('index.ALPR')
+    def test_model_stages_timed(self, mock_alpr):
+        index.ALPR_MODELS.clear()
+        index.config = {'fast_alpr': {'plate_detector_model': 'detector', 'ocr_model': 'ocr'}}
+        alpr = index.get_alpr()
+
+        alpr.detector.predict('image')
+        alpr.ocr.predict('plate')
+        alpr.ocr.predict('plate')
+
+        self.assertEqual(index.STAGE_DURATIONS['detection'].snapshot()[0][-1], 1)
+        self.assertEqual(index.STAGE_DURATIONS['ocr'].snapshot()[0][-1], 2)
+
+    def test_metrics_endpoint(self):
+        index.config = {'metrics_port': 0, 'metrics_host': '127.0.0.1'}
+        index.start_metrics_server()
+        try:
+            url = f"http://127.0.0.1:{index.metrics_server.server_port}"
+            response = index.requests.get(f"{url}/metrics", timeout=5)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('# TYPE plate_recognizer_active_events gauge', response.text)
+            self.assertEqual(index.requests.get(f"{url}/other", timeout=5).status_code, 404)
+        finally:
+            index.metrics_server.shutdown()
+            index.metrics_server.server_close()
+
+
+class TestEventTraces(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = patch.object(index, 'DB_PATH', os.path.join(self.tmp_dir.name, 'plates.db'))
+        self.db_path.start()
+        index.db_local = threading.local()
+        index.EVENT_TRACES.clear()
+        index.config = {}
+        index.setup_db()
+        self.db_write_queue = patch('index.db_write_queue', queue.Queue())
+        self.db_write_queue.start()
+
+    def tearDown(self):
+        self.db_write_queue.stop()
+        index.db_local.conn.close()
+        index.db_local = threading.local()
+        self.db_path.stop()
+        self.tmp_dir.cleanup()
+
+    def trace_event(self, frigate_event_id, sleep):
+        def attempt():
+            with index.stage('snapshot'):
+                time.sleep(sleep)
+            with index.stage('detection'):
+                pass
+        index.start_trace(frigate_event_id, 'camera1')
+        for _ in range(2):
+            index.trace_attempt(frigate_event_id)
+            index.run_traced(frigate_event_id, attempt)
+        index.finish_trace(frigate_event_id, 2, "plate resolved")
+        index.write_db_batch([index.db_write_queue.get_nowait()])
+
+    def test_trace_records_stages_per_attempt(self):
+        self.trace_event('event1', 0.01)
+
+        trace, = index.get_slowest_traces(1, 10)
+        self.assertEqual(trace['frigate_event_id'], 'event1')
+        self.assertEqual(trace['outcome'], "plate resolved")
+        self.assertEqual([(name, attempt) for name, attempt, _, _ in trace['spans']],
+                         [('snapshot', 1), ('detection', 1), ('snapshot', 2), ('detection', 2)])
+        self.assertGreaterEqual(index.get_stage_breakdown(trace['spans'])['snapshot'], 20)
+        self.assertNotIn('event1', index.EVENT_TRACES)
+
+    def test_stages_outside_traced_events_are_not_recorded(self):
+        index.start_trace('event1', 'camera1')
+        with index.stage('snapshot'):
+            pass
+        self.assertEqual(index.EVENT_TRACES['event1']['spans'], [])
+
+    def test_sampling(self):
+        index.config = {'trace_sample_rate': 0}
+        index.start_trace('event1', 'camera1')
+        index.finish_trace('event1', 1, "ended")
+
+        self.assertNotIn('event1', index.EVENT_TRACES)
+        self.assertTrue(index.db_write_queue.empty())
+
+    def test_slowest_traces_first(self):
+        self.trace_event('fast', 0)
+        self.trace_event('slow', 0.02)
+
+        self.assertEqual([trace['frigate_event_id'] for trace in index.get_slowest_traces(1, 10)], ['slow', 'fast'])
+        self.assertEqual([trace['frigate_event_id'] for trace in index.get_slowest_traces(1, 1)], ['slow'])
+
+    @patch('builtins.print')
+    def test_traces_command(self, mock_print):
+        self.trace_event('event1', 0)
+        with patch('sys.argv', ['index.py', 'traces', '--hours', '1']):
+            index.main()
+
+        output = [call.args[0] for call in mock_print.call_args_list]
+        self.assertTrue(output[0].startswith('event1 camera1'))
+        self.assertIn('first fetch after', output[1])
+        self.assertTrue(any(line.strip().startswith('snapshot') for line in output))
+
+    @patch('builtins.print')
+    def test_traces_command_on_new_database(self, mock_print):
+        index.db_local.conn.close()
+        index.db_local = threading.local()
+        index.DB_PATH = os.path.join(self.tmp_dir.name, 'new.db')
+        with patch('sys.argv', ['index.py', 'traces']):
+            index.main()
+
+        mock_print.assert_called_once_with("No traced events in the last 24 hours")
+
+    @patch('index.process_events', return_value=True)
+    def test_worker_attempts_are_traced(self, mock_process_events):
+        index.config = {'frigate': {}}
+        event = {'id': 'event1', 'after_data': {'camera': 'camera1'}, 'frigate_url': 'http://example.com',
+                 'attempts': 0, 'in_flight': True, 'cancelled': False}
+        def process_events(after_data, frigate_url, frigate_event_id):
+            with index.stage('snapshot'):
+                return True
+        mock_process_events.side_effect = process_events
+        index.start_trace('event1', 'camera1')
+        index.work_queue.clear()
+        index.CURRENT_EVENTS.clear()
+        index.work_queue.append(event)
+        index.CURRENT_EVENTS['event1'] = event
+
+        stopped = threading.Event()
+        worker = threading.Thread(target=index.run_recognition_worker, args=(stopped,), daemon=True)
+        worker.start()
+        try:
+            sql, params = index.db_write_queue.get(timeout=5)
+        finally:
+            stopped.set()
+            with index.events_lock:
+                index.work_condition.notify_all()
+            worker.join(timeout=5)
+        self.assertFalse(worker.is_alive())
+
+        self.assertIn('INSERT INTO traces', sql)
+        self.assertEqual(params[0], 'event1')
+        self.assertEqual(params[4:6], (1, "plate resolved"))
+        self.assertEqual(json.loads(params[6])[0][:2], ['snapshot', 1])
+
+
+class TestIngest(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        index.config = {'frigate': {'camera': ['camera1'], 'objects': ['car']}}
+        index.INGEST_STATS.update(dropped=0, filtered=0, queued=0)
+
+    def tearDown(self):
+        index.ingest_queue = None
+
+    def make_message(self, event_type='new', camera='camera1', label='car'):
+        after_data = {'id': 'event1', 'camera': camera, 'label': label, 'current_zones': []}
+        return MagicMock(topic='frigate/events', payload=json.dumps({'type': event_type, 'before': after_data, 'after': after_data}).encode())
+
+    def test_prefilter(self):
+        self.assertTrue(index.is_relevant_payload(self.make_message().payload))
+        self.assertTrue(index.is_relevant_payload(self.make_message('end').payload))
+        self.assertFalse(index.is_relevant_payload(self.make_message(camera='camera2').payload))
+        self.assertFalse(index.is_relevant_payload(self.make_message(label='person').payload))
+        self.assertFalse(index.is_relevant_payload(self.make_message('other').payload))
+        self.assertFalse(index.is_relevant_payload(b'not json'))
+
+    def test_prefilter_defaults(self):
+        index.config = {'frigate': {}}
+        self.assertTrue(index.is_relevant_payload(self.make_message(camera='camera2', label='bus').payload))
+        self.assertFalse(index.is_relevant_payload(self.make_message(label='dog').payload))
+
+        index.config = {'frigate': {'ingest_prefilter': False}}
+        self.assertTrue(index.is_relevant_payload(self.make_message(label='dog').payload))
+
+    @patch('index.process_message')
+    def test_filtered_messages_are_not_decoded(self, mock_process_message):
+        with patch('json.loads') as mock_loads:
+            index.on_message(None, None, self.make_message(label='person'))
+            mock_loads.assert_not_called()
+        mock_process_message.assert_not_called()
+        self.assertEqual(index.INGEST_STATS['filtered'], 1)
+
+    @patch('index.process_message')
+    def test_messages_are_queued_off_the_network_thread(self, mock_process_message):
+        index.ingest_queue = queue.Queue(maxsize=1)
+        message = self.make_message()
+        index.on_message(None, None, message)
+        index.on_message(None, None, self.make_message('update'))
+
+        mock_process_message.assert_not_called()
+        self.assertIs(index.ingest_queue.get_nowait(), message)
+        self.assertEqual(index.get_ingest_stats(), {'dropped': 1, 'filtered': 0, 'queued': 1, 'queue_depth': 0})
+
+    @patch('index.process_message')
+    def test_end_messages_are_never_dropped(self, mock_process_message):
+        index.ingest_queue = queue.Queue(maxsize=2)
+        new_message = self.make_message()
+        update_message = self.make_message('update')
+        end_message = self.make_message('end')
+        index.on_message(None, None, new_message)
+        index.on_message(None, None, update_message)
+        index.on_message(None, None, end_message)
+
+        self.assertEqual([index.ingest_queue.get_nowait(), index.ingest_queue.get_nowait()], [new_message, end_message])
+        self.assertEqual(index.INGEST_STATS['dropped'], 1)
+
+    @patch('index.process_message')
+    def test_end_messages_held_when_queue_has_no_updates(self, mock_process_message):
+        index.ingest_queue = queue.Queue(maxsize=1)
+        new_message = self.make_message()
+        end_message = self.make_message('end')
+        index.on_message(None, None, new_message)
+        index.on_message(None, None, end_message)
+
+        self.assertEqual([index.get_ingest_message(index.ingest_queue), index.get_ingest_message(index.ingest_queue)], [new_message, end_message])
+        self.assertEqual(index.INGEST_STATS['dropped'], 0)
+        self.assertEqual(len(index.ingest_overflow), 0)
+
+    def test_ingest_thread_processes_messages(self):
+        processed = threading.Event()
+        with patch('index.process_message', side_effect=lambda message: processed.set()):
+            index.start_ingest()
+            index.on_message(None, None, self.make_message())
+            self.assertTrue(processed.wait(5))
+
+
+class TestReadability(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        index.CURRENT_EVENTS.clear()
+        index.work_queue.clear()
+        index.config = {'frigate': {
+            'attempt_interval': 0,
+            'detect_resolution': {'camera1': [1280, 720]},
+            'readability': {
+                'min_box_width': 100,
+                'min_box_fraction': 0.1,
+                'min_area': 10000,
+                'min_ratio': 0.5,
+                'max_ratio': 3,
+                'max_motionless_count': 50,
+                'cameras': {'camera2': {'min_box_width': 50}},
+            },
+        }}
+
+    def make_after_data(self, camera='camera1', box=(100, 100, 300, 250), **kwargs):
+        box_width, box_height = box[2] - box[0], box[3] - box[1]
+        after_data = {'id': 'event1', 'camera': camera, 'box': list(box), 'area': box_width * box_height,
+                      'ratio': box_width / box_height, 'stationary': False, 'motionless_count': 0, 'position_changes': 0}
+        after_data.update(kwargs)
+        return after_data
+
+    def test_gate_disabled_by_default(self):
+        index.config = {'frigate': {}}
+        self.assertEqual(index.get_readability(self.make_after_data(box=(0, 0, 10, 10))), 'now')
+
+    def test_readable_object(self):
+        self.assertEqual(index.get_readability(self.make_after_data()), 'now')
+
+    def test_small_objects_are_read_later(self):
+        self.assertEqual(index.get_readability(self.make_after_data(box=(100, 100, 180, 160))), 'later')
+        self.assertEqual(index.get_readability(self.make_after_data(area=5000)), 'later')
+        self.assertEqual(index.get_readability(self.make_after_data(ratio=5)), 'later')
+
+    def test_box_fraction_uses_detect_resolution(self):
+        after_data = self.make_after_data(box=(100, 100, 220, 160), area=20000, ratio=1)
+        self.assertEqual(index.get_readability(after_data), 'later')
+
+        del index.config['frigate']['detect_resolution']
+        self.assertEqual(index.get_readability(after_data), 'now')
+
+    def test_per_camera_thresholds(self):
+        after_data = self.make_after_data(camera='camera2', box=(100, 100, 180, 160), area=20000, ratio=1)
+        self.assertEqual(index.get_readability(after_data), 'now')
+
+    def test_parked_objects_are_never_read(self):
+        after_data = self.make_after_data(stationary=True, motionless_count=100)
+        self.assertEqual(index.get_readability(after_data), 'never')
+
+        # a car that drove in before stopping may still be waiting for a better view
+        after_data['position_changes'] = 2
+        self.assertEqual(index.get_readability(after_data), 'later')
+
+        after_data['motionless_count'] = 10
+        self.assertEqual(index.get_readability(after_data), 'now')
+
+    def test_scheduler_waits_for_readable_update(self):
+        index.start_event(self.make_after_data(box=(100, 100, 150, 130)), 'http://example.com', 'event1')
+        with index.events_lock:
+            index.schedule_due_events()
+        self.assertEqual(len(index.work_queue), 0)
+        self.assertIsNone(index.CURRENT_EVENTS['event1']['next_attempt'])
+
+        index.update_event('event1', self.make_after_data())
+        with index.events_lock:
+            index.schedule_due_events()
+        self.assertEqual(len(index.work_queue), 1)
+
+    def test_scheduler_drops_parked_event(self):
+        index.start_event(self.make_after_data(stationary=True, motionless_count=100), 'http://example.com', 'event1')
+        with index.events_lock:
+            index.schedule_due_events()
+        self.assertEqual(len(index.work_queue), 0)
+        self.assertNotIn('event1', index.CURRENT_EVENTS)
+
+
+class TestPlateAttributeOcr(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        index.config = {
+            'frigate': {'frigate_plus': True, 'license_plate_min_score': 0.5, 'detect_resolution': {'camera1': [320, 240]}},
+            'fast_alpr': {},
+        }
+        self.frame = index.Frame(make_jpeg(640, 480))
+        self.after_data = {'id': 'event1', 'camera': 'camera1', 'current_attributes': [
+            {'label': 'license_plate', 'box': [100, 100, 150, 120], 'score': 0.8},
+            {'label': 'face', 'box': [0, 0, 10, 10], 'score': 0.9},
+        ]}
+
+    @patch('index.get_alpr')
+    def test_runs_only_ocr_on_attribute_box(self, mock_get_alpr):
+        mock_get_alpr.return_value.ocr.predict.return_value = OcrResult(text='ABC123', confidence=0.9)
+
+        results = index.predict_plates(self.frame, self.after_data)
+
+        mock_get_alpr.return_value.predict.assert_not_called()
+        mock_get_alpr.return_value.detector.predict.assert_not_called()
+        self.assertEqual(mock_get_alpr.return_value.ocr.predict.call_args[0][0].shape, (48, 120, 3))
+        self.assertEqual(results[0].ocr.text, 'ABC123')
+        self.assertEqual(results[0].detection.bounding_box, BoundingBox(x1=190, y1=196, x2=310, y2=244))
+        self.assertEqual(results[0].detection.confidence, 0.8)
+
+    @patch('index.get_alpr')
+    def test_falls_back_to_detector_below_min_score(self, mock_get_alpr):
+        self.after_data['current_attributes'][0]['score'] = 0.4
+        mock_get_alpr.return_value.predict.return_value = [make_alpr_result()]
+
+        results = index.predict_plates(self.frame, self.after_data)
+
+        mock_get_alpr.return_value.ocr.predict.assert_not_called()
+        self.assertEqual(results, [make_alpr_result()])
+
+    @patch('index.get_alpr')
+    def test_falls_back_to_detector_without_text(self, mock_get_alpr):
+        mock_get_alpr.return_value.ocr.predict.return_value = OcrResult(text='', confidence=0.1)
+        mock_get_alpr.return_value.predict.return_value = [make_alpr_result()]
+
+        self.assertEqual(index.predict_plates(self.frame, self.after_data), [make_alpr_result()])
+        mock_get_alpr.return_value.predict.assert_called_once()
+
+    @patch('index.get_alpr')
+    def test_event_snapshots_use_detector(self, mock_get_alpr):
+        index.config['frigate']['snapshot'] = {'source': 'snapshot'}
+        mock_get_alpr.return_value.predict.return_value = []
+
+        index.predict_plates(self.frame, self.after_data)
+
+        mock_get_alpr.return_value.ocr.predict.assert_not_called()
+        mock_get_alpr.return_value.predict.assert_called_once()
+
+
+class TestStreamReader(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.video_path = os.path.join(self.tmp_dir.name, 'camera1.avi')
+        writer = cv2.VideoWriter(self.video_path, cv2.VideoWriter_fourcc(*'MJPG'), 20, (64, 48))
+        for i in range(10):
+            writer.write(np.full((48, 64, 3), i * 20, np.uint8))
+        writer.release()
+        index.STREAM_READERS.clear()
+        index.config = {'frigate': {'snapshot': {'cameras': {'camera1': {
+            'source': 'stream', 'stream_url': self.video_path, 'stream_idle_timeout': 0.2}}}}}
+
+    def tearDown(self):
+        for reader in index.STREAM_READERS.values():
+            reader.stop()
+            reader.thread.join(timeout=1)
+        self.tmp_dir.cleanup()
+
+    def test_reads_latest_frames_from_video_file(self):
+        reader = index.StreamReader(self.video_path)
+        try:
+            first = reader.get_frame()
+            self.assertEqual(first.shape, (48, 64, 3))
+            time.sleep(0.2)
+            self.assertEqual(reader.retrieved, 1)
+            self.assertFalse(np.array_equal(reader.get_frame(), first))
+            self.assertEqual(reader.retrieved, 2)
+        finally:
+            reader.stop()
+            reader.thread.join(timeout=1)
+
+    @patch('index.frigate_client')
+    def test_snapshot_from_stream(self, mock_frigate_client):
+        frame = index.get_snapshot('event1', 'camera1')
+
+        mock_frigate_client.get_snapshot.assert_not_called()
+        self.assertIsInstance(frame, index.Frame)
+        self.assertIsNone(frame.data)
+        self.assertEqual(frame.image.shape, (48, 64, 3))
+
+    def test_reader_started_with_event(self):
+        index.start_event({'id': 'event1', 'camera': 'camera1'}, 'http://example.com', 'event1')
+        index.cancel_event('event1')
+        self.assertIn('camera1', index.STREAM_READERS)
+
+    def test_reader_stops_when_idle(self):
+        reader = index.get_stream_reader('camera1', index.get_snapshot_config('camera1'))
+        reader.get_frame()
+        reader.thread.join(timeout=2)
+
+        self.assertFalse(reader.is_running())
+        new_reader = index.get_stream_reader('camera1', index.get_snapshot_config('camera1'))
+        self.assertIsNot(new_reader, reader)
+        self.assertIsNotNone(new_reader.get_frame())
+
+    def test_unavailable_stream(self):
+        index.config['frigate']['snapshot']['cameras']['camera1'].update(
+            stream_url=os.path.join(self.tmp_dir.name, 'missing.avi'), stream_wait=0.1)
+        self.assertIsNone(index.get_snapshot('event1', 'camera1'))
+
+
+class TestClipScan(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.clip_path = os.path.join(self.tmp_dir.name, 'camera1-event1.avi')
+        writer = cv2.VideoWriter(self.clip_path, cv2.VideoWriter_fourcc(*'MJPG'), 10, (64, 48))
+        for i in range(40):
+            image = np.zeros((48, 64, 3), np.uint8)
+            if i == 20:
+                image[::2, ::2] = 255
+            writer.write(image)
+        writer.release()
+        index.config = {'frigate': {'frigate_url': 'http://example.com', 'watched_plates': ['ABC123'], 'fuzzy_match': 0.8,
+                                    'clip_scan': {'frames': 2, 'sample_interval': 0.5, 'pre_capture': 1, 'post_capture': 1}},
+                        'fast_alpr': {}}
+        index.UNRESOLVED_EVENTS.clear()
+        index.RESOLVED_EVENTS.clear()
+        index.clip_scan_queue = queue.Queue(maxsize=1)
+        self.after_data = {'id': 'event1', 'camera': 'camera1', 'start_time': 1700000000}
+
+    def tearDown(self):
+        index.clip_scan_queue = None
+        self.tmp_dir.cleanup()
+
+    def test_samples_sharpest_frames_in_track(self):
+        images = index.sample_clip_frames(self.clip_path, index.get_clip_scan_config())
+
+        self.assertEqual(len(images), 2)
+        self.assertGreater(index.get_sharpness(images[0]), index.get_sharpness(images[1]))
+
+    def test_only_unresolved_events_are_queued(self):
+        index.request_clip_scan(self.after_data)
+        self.assertTrue(index.clip_scan_queue.empty())
+
+        index.remember_unresolved_event('event1')
+        index.request_clip_scan(self.after_data)
+        self.assertEqual(index.clip_scan_queue.get_nowait(), self.after_data)
+        self.assertNotIn('event1', index.UNRESOLVED_EVENTS)
+
+    def test_full_queue_drops_scan(self):
+        dropped = index.CLIP_SCAN_STATS['dropped']
+        for event_id in ('event1', 'event2'):
+            index.remember_unresolved_event(event_id)
+            index.request_clip_scan(dict(self.after_data, id=event_id))
+        self.assertEqual(index.CLIP_SCAN_STATS['dropped'], dropped + 1)
+
+    @patch('index.frigate_client')
+    def test_reads_clip_from_recordings_directory(self, mock_frigate_client):
+        clip_path = os.path.join(self.tmp_dir.name, 'camera1-event1.mp4')
+        open(clip_path, 'wb').close()
+
+        self.assertEqual(index.get_event_clip(self.after_data, {'clips_path': self.tmp_dir.name}), (clip_path, False))
+        mock_frigate_client.get.assert_not_called()
+
+    @patch('index.frigate_client')
+    def test_downloads_clip(self, mock_frigate_client):
+        mock_frigate_client.get.return_value.status_code = 200
+        mock_frigate_client.get.return_value.content = b'clip'
+
+        clip_path, downloaded = index.get_event_clip(self.after_data, {})
+        with open(clip_path, 'rb') as clip_file:
+            self.assertEqual(clip_file.read(), b'clip')
+        os.remove(clip_path)
+        self.assertTrue(downloaded)
+        mock_frigate_client.get.assert_called_once_with('/api/events/event1/clip.mp4')
+
+    @patch('index.report_watched_plate')
+    @patch('index.predict_batch')
+    @patch('index.get_event_clip')
+    def test_scan_reports_watched_plate(self, mock_get_event_clip, mock_predict_batch, mock_report_watched_plate):
+        mock_get_event_clip.return_value = (self.clip_path, False)
+        mock_predict_batch.return_value = [[make_alpr_result()], []]
+
+        self.assertTrue(index.scan_event_clip(self.after_data))
+
+        self.assertEqual(len(mock_predict_batch.call_args[0][0]), 2)
+        self.assertEqual(mock_report_watched_plate.call_args[0][4], 'ABC123')
+        self.assertTrue(os.path.exists(self.clip_path))
+        self.assertNotIn('event1', index.PLATE_READS)
+
+    @patch('index.report_watched_plate')
+    @patch('index.predict_batch')
+    @patch('index.get_event_clip')
+    def test_scan_without_plate(self, mock_get_event_clip, mock_predict_batch, mock_report_watched_plate):
+        mock_get_event_clip.return_value = (self.clip_path, False)
+        mock_predict_batch.return_value = [[], []]
+
+        self.assertFalse(index.scan_event_clip(self.after_data))
+        mock_report_watched_plate.assert_not_called()
+
+
+class TestBenchmarkReplay(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.config_path = os.path.join(self.tmp_dir.name, 'config.yml')
+        with open(self.config_path, 'w') as config_file:
+            yaml.dump({'frigate': {'main_topic': 'frigate', 'frigate_url': 'http://example.com', 'camera': ['camera1'],
+                                   'objects': ['car'], 'attempt_interval': 0.05}}, config_file)
+        with open(os.path.join(self.tmp_dir.name, 'camera1.jpg'), 'wb') as snapshot_file:
+            snapshot_file.write(make_jpeg())
+        messages = [
+            self.make_message('new', 'event1', 100.0),
+            self.make_message('new', 'event2', 100.0),
+            self.make_message('end', 'event2', 100.0),
+            self.make_message('update', 'event1', 100.1),
+            self.make_message('end', 'event1', 100.4),
+        ]
+        with open(os.path.join(self.tmp_dir.name, 'events.json'), 'w') as events_file:
+            json.dump(messages, events_file)
+        self.patches = patch.multiple(
+            'index', config=None, DB_PATH=os.path.join(self.tmp_dir.name, 'plates.db'), SNAPSHOT_PATH=self.tmp_dir.name,
+            db_local=threading.local(), db_write_queue=queue.Queue(), mqtt_client=None, executor=None,
+            delayed_actions=None, frigate_client=None, recognize_snapshot=MagicMock(return_value=False))
+        self.patches.start()
+
+    def tearDown(self):
+        self.patches.stop()
+        self.tmp_dir.cleanup()
+
+    def make_message(self, event_type, frigate_event_id, frame_time):
+        after_data = {'id': frigate_event_id, 'camera': 'camera1', 'label': 'car', 'current_zones': [],
+                      'frame_time': frame_time, 'start_time': 100.0}
+        return {'type': event_type, 'before': after_data, 'after': after_data}
+
+    def test_messages_replayed_by_frame_time(self):
+        offsets = [offset for offset, _ in benchmark.load_recorded_messages(self.tmp_dir.name, 2)]
+        self.assertEqual(len(offsets), 10)
+        self.assertEqual(offsets, sorted(offsets))
+        self.assertAlmostEqual(offsets[-1], 0.4)
+
+    @patch('builtins.print')
+    def test_only_attempted_events_complete(self, mock_print):
+        args = benchmark.argparse.Namespace(config=self.config_path, events=self.tmp_dir.name, rate=None, speed=1,
+                                            concurrency=2, repeat=1, drain_timeout=5)
+        start_time = time.perf_counter()
+        benchmark.benchmark_replay(args)
+
+        output = [call.args[0] for call in mock_print.call_args_list][-4:]
+        self.assertGreaterEqual(time.perf_counter() - start_time, 0.4)
+        self.assertIn("events: 2 completed: 1 ended without attempt: 1 unfinished: 0", output[0])
+        self.assertNotIn("snapshot requests: 0", output[3])
+        self.assertGreater(index.recognize_snapshot.call_count, 0)
+
+
 if __name__ == '__main__':
     unittest.main()